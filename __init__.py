@@ -1,30 +1,42 @@
 from .generate_latent_gaussian import LTRandomGaussian
 from .generate_latent_uniform import LTRandomUniform
 from .load_latent import LTLatentLoad
+from .save_latent import LTLatentSave
 
 from .preview_latent import LTPreviewLatent
-from .reshape_latent import LTReshapeLatent, LTLatentToShape
-from .blend_latent import LTBlendLatent
-from .latent_op import LTLatentOp
-from .concat_latent import LTLatentsConcatenate
+from .reshape_latent import LTReshapeLatent, LTLatentToShape, LTRearrangeLatent, LTTileLatent
+from .blend_latent import LTBlendLatent, LTBlendLatentSchedule
+from .latent_op import LTLatentOp, LTLatentExpr
+from .concat_latent import LTLatentsConcatenate, LTLatentsConcatenateList
 
-from .samplers import LTKSampler
+from .samplers import LTKSampler, LTKSamplerSweep, LTSamplerEulerAncestral
 
-from .param_search import LTNumberRangeGaussian, LTNumberRangeUniform, LTFloatSteps
+from .param_search import LTNumberRangeGaussian, LTNumberRangeUniform, LTNumberListUniform, LTNumberListGaussian, LTParamDesign, LTFloatSteps
 
 NODE_CLASS_MAPPINGS = {
     "LTLatentLoad": LTLatentLoad,
+    "LTLatentSave": LTLatentSave,
     "LTLatentsConcatenate": LTLatentsConcatenate,
+    "LTLatentsConcatenateList": LTLatentsConcatenateList,
     "LTPreviewLatent": LTPreviewLatent,
     "LTGaussianLatent": LTRandomGaussian,
     "LTUniformLatent": LTRandomUniform,
     "LTKSampler": LTKSampler,
+    "LTKSamplerSweep": LTKSamplerSweep,
+    "LTSamplerEulerAncestral": LTSamplerEulerAncestral,
     "LTReshapeLatent": LTReshapeLatent,
     "LTLatentToShape": LTLatentToShape,
+    "LTRearrangeLatent": LTRearrangeLatent,
+    "LTTileLatent": LTTileLatent,
     "LTBlendLatent": LTBlendLatent,
+    "LTBlendLatentSchedule": LTBlendLatentSchedule,
     "LTLatentOp": LTLatentOp,
+    "LTLatentExpr": LTLatentExpr,
     "LTNumberRangeUniform": LTNumberRangeUniform,
     "LTNumberRangeGaussian": LTNumberRangeGaussian,
+    "LTNumberListUniform": LTNumberListUniform,
+    "LTNumberListGaussian": LTNumberListGaussian,
+    "LTParamDesign": LTParamDesign,
 } | { f.__name__: f for f in LTFloatSteps }
 
 WEB_DIRECTORY="./web/js"
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Time and peak memory of the latent-tools kernels against the implementations they replaced.
+
+Usage: python bin/benchmark.py [case ...] [--device cuda] [--repeat 10]
+
+On CUDA, the peak memory is the allocator high watermark. On CPU, every variant runs in a fresh process,
+and the peak is the growth of the process max RSS while the variant runs, over what its inputs already use.
+"""
+import argparse, importlib, os, sys, time, types
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_lt(name: str):
+    """Import a module of the package without running its __init__.py, which needs a running ComfyUI"""
+    if "latent_tools" not in sys.modules:
+        pkg = types.ModuleType("latent_tools")
+        pkg.__path__ = [ROOT]
+        sys.modules["latent_tools"] = pkg
+    return importlib.import_module(f"latent_tools.{name}")
+
+# name -> function(device) that returns {variant: zero-argument callable}. The inputs are created by that function.
+CASES = {}
+
+def case(fn):
+    CASES[fn.__name__.removeprefix("bench_")] = fn
+    return fn
+
+
+@case
+def bench_normalize(device):
+    import torch
+    normalize = import_lt("normalize")
+
+    x = torch.randn(1, 16, 61, 104, 184, device=device)
+    dims = normalize.normalize_dims(x, "frame")
+
+    def legacy():
+        means = torch.mean(x, dim=dims, keepdim=True)
+        stds = torch.std(x, dim=dims, keepdim=True)
+        return (x - means) / stds
+
+    return {
+        "legacy mean/std": legacy,
+        "std_mean": lambda: normalize.normalize(x, dims),
+        "std_mean in place": lambda: normalize.normalize(x, dims, inplace=True),
+    }
+
+
+@case
+def bench_noise(device):
+    import torch
+    noise = import_lt("noise")
+    shape = (16, 16, 128, 128)
+
+    def legacy():
+        generator = torch.Generator()
+        generator.manual_seed(0)
+        return (torch.randn(shape, generator=generator) * 1. + 0.).to(torch.float16)
+
+    return {
+        "legacy cpu generator fp16": legacy,
+        "philox fp32": lambda: noise.generate_noise(shape, "gaussian", 0, 1., 0., "philox", torch.float32, torch.device(device)),
+        "philox fp16": lambda: noise.generate_noise(shape, "gaussian", 0, 1., 0., "philox", torch.float16, torch.device(device)),
+    }
+
+
+def _bench_prepare_noise(device, shuffle):
+    import torch
+    import numpy as np
+    noise = import_lt("noise")
+    x = torch.randn(2048, 4, 32, 32, device=device)
+    inds = torch.randperm(2048).tolist() if shuffle else list(range(2048))
+
+    # samplers.lt_prepare_noise before the rewrite
+    def legacy():
+        unique_inds = np.unique(inds)
+        noises = [x[i:i+1] for i in unique_inds]
+        return torch.cat([noises[np.where(unique_inds == i)[0][0]] for i in inds], dim=0)
+
+    return {"legacy unique/where/cat": legacy, "index_select": lambda: noise.lt_prepare_noise(x, inds)}
+
+@case
+def bench_prepare_noise(device): return _bench_prepare_noise(device, shuffle=True)
+
+@case
+def bench_prepare_noise_identity(device): return _bench_prepare_noise(device, shuffle=False)
+
+
+@case
+def bench_noise_timeline(device):
+    import torch
+    noise = import_lt("noise")
+    # 30 steps of SDXL noise for a batch of 4
+    x = torch.randn(4, 30, 4, 128, 128)
+
+    # QSamplerEulerAncestral's noise_sampler before the rewrite, without the prints
+    def legacy():
+        for i in range(30): x[:, i].to(device)
+        if device.startswith("cuda"): torch.cuda.synchronize()
+
+    def timeline(prefetch):
+        def run():
+            sampler = noise.NoiseTimeline(x, torch.device(device), prefetch)
+            for _ in range(30): sampler(1., 0.)
+        return run
+
+    return {"legacy per-step .to": legacy} | {prefetch: timeline(prefetch) for prefetch in noise.prefetch_options}
+
+
+def _bench_blend(device, mode):
+    import torch
+    blend = import_lt("blend_latent")
+    x1 = torch.randn(1, 16, 61, 104, 184, device=device)
+    x2 = torch.randn(1, 16, 61, 104, 184, device=device)
+    # The first call imports torch._refs, don't count that as blend memory.
+    torch.broadcast_shapes(x1.shape, x2.shape)
+
+    # LTBlendLatent before the rewrite
+    legacy = {
+        "interpolate": lambda: x1 * 0.3 + x2 * (1 - 0.3),
+        "add": lambda: x1 + x2,
+        "multiply": lambda: x1 * x2,
+        "abs_max": lambda: torch.where(torch.abs(x1) > torch.abs(x2), x1, x2),
+        "abs_min": lambda: torch.where(torch.abs(x1) < torch.abs(x2), x1, x2),
+        "max": lambda: torch.maximum(x1, x2),
+        "min": lambda: torch.minimum(x1, x2),
+        "sample": lambda: torch.manual_seed(0) and torch.where(torch.rand_like(x1) >= 0.3, x1, x2),
+    }
+    return {"legacy": legacy[mode], "blend_samples": lambda: blend.blend_samples(x1, x2, mode, 0.3, 0)}
+
+@case
+def bench_blend_interpolate(device): return _bench_blend(device, "interpolate")
+
+@case
+def bench_blend_add(device): return _bench_blend(device, "add")
+
+@case
+def bench_blend_multiply(device): return _bench_blend(device, "multiply")
+
+@case
+def bench_blend_abs_max(device): return _bench_blend(device, "abs_max")
+
+@case
+def bench_blend_abs_min(device): return _bench_blend(device, "abs_min")
+
+@case
+def bench_blend_max(device): return _bench_blend(device, "max")
+
+@case
+def bench_blend_min(device): return _bench_blend(device, "min")
+
+@case
+def bench_blend_sample(device): return _bench_blend(device, "sample")
+
+
+@case
+def bench_save(device):
+    import tempfile, torch
+    latent_io = import_lt("latent_io")
+    x = torch.randn(16, 16, 128, 128, device=device)
+    folder = tempfile.mkdtemp()
+
+    def save(name, dtype=None):
+        return lambda: latent_io.write_latent(os.path.join(folder, name), x.to(dtype) if dtype else x)
+
+    variants = {"safetensors": save("x.safetensors"), "safetensors fp16": save("x16.safetensors", torch.float16)}
+    if latent_io.zstandard is not None:
+        variants |= {"safetensors zstd": save("x.safetensors.zst"), "safetensors fp16 zstd": save("x16.safetensors.zst", torch.float16)}
+    return variants
+
+
+def _bench_preview(device, shape):
+    import torch, matplotlib
+    matplotlib.use("Agg")
+    render = import_lt("preview_render")
+    x = torch.randn(shape, device=device).cpu()
+
+    def preview(renderer):
+        return lambda: (render.plot_png(x, renderer), render.chans_png(x, renderer))
+
+    return {renderer: preview(renderer) for renderer in render.renderers}
+
+@case
+def bench_preview_sdxl(device): return _bench_preview(device, (1, 4, 128, 128))
+
+@case
+def bench_preview_flux(device): return _bench_preview(device, (1, 16, 128, 128))
+
+@case
+def bench_preview_video(device): return _bench_preview(device, (1, 16, 21, 60, 104))
+
+
+def _maxrss_mib() -> float:
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+def run_variant(name: str, variant: str, device: str, repeat: int) -> tuple[float, float]:
+    """Returns (best time in ms, peak memory in MiB)"""
+    import torch
+    fn = CASES[name](device)[variant]
+
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        peak = (torch.cuda.max_memory_allocated() - base) / (1024 * 1024)
+    else:
+        base = _maxrss_mib()
+        fn()
+        peak = _maxrss_mib() - base
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        if device.startswith("cuda"): torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cases", nargs="*", help=f"Cases to run, all by default: {', '.join(CASES)}")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    for name in args.cases:
+        if name not in CASES: parser.error(f"Unknown case: {name}")
+
+    ctx = mp.get_context("spawn")
+    for name in args.cases or CASES:
+        print(f"{name}:")
+        variants = list(CASES[name](args.device))
+        for variant in variants:
+            # A fresh process for each variant, so the CPU max RSS is not polluted by the previous ones.
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                ms, mib = pool.submit(run_variant, name, variant, args.device, args.repeat).result()
+            print(f"    {variant:<32} {ms:10.2f} ms {mib:10.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
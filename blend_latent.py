@@ -1,7 +1,83 @@
 import torch
 
+from .noise import latent_samples, philox_bits, chunk_size
+
 blend_choice = ["interpolate", "add", "multiply", "abs_max", "abs_min", "max", "min", "sample"]
 
+# Elements of the output computed at once. Bounds the size of the temporaries for the large video latents.
+blend_chunk_elements = 1 << 22
+# Philox stream of the sample mask, so it's not correlated with Philox noise of the same seed.
+_mask_stream = 1
+
+
+def sample_mask(start: int, count: int, ratio: float, seed: int, device: torch.device) -> torch.Tensor:
+    """Elements [start, start + count) of the mask for mode=sample: True (take latent1) with probability 1 - ratio.
+
+    The mask comes from the counter-based Philox sequence, so it's the same for any chunking and device.
+    """
+    # Comparing the raw 32 bit values with the threshold, no floats needed.
+    threshold = round(ratio * 2 ** 32)
+    mask = torch.empty(count, dtype=torch.bool, device=device)
+    for s in range(0, count, chunk_size):
+        e = min(s + chunk_size, count)
+        torch.ge(philox_bits(start + s, e - s, seed, device, stream=_mask_stream), threshold, out=mask[s:e])
+    return mask
+
+
+def _blend_into(out: torch.Tensor, samples1: torch.Tensor, samples2: torch.Tensor, mode: str, ratio: float, seed: int, start: int):
+    # start: the position of out in the flattened output, for the sample mask.
+    if mode == "interpolate":
+        torch.lerp(samples2, samples1, ratio, out=out)
+    elif mode == "add":
+        torch.add(samples1, samples2, out=out)
+    elif mode == "multiply":
+        torch.mul(samples1, samples2, out=out)
+    elif mode == "abs_max":
+        torch.where(samples1.abs() > samples2.abs(), samples1, samples2, out=out)
+    elif mode == "abs_min":
+        torch.where(samples1.abs() < samples2.abs(), samples1, samples2, out=out)
+    elif mode == "max":
+        torch.maximum(samples1, samples2, out=out)
+    elif mode == "min":
+        torch.minimum(samples1, samples2, out=out)
+    elif mode == "sample":
+        torch.where(sample_mask(start, out.numel(), ratio, seed, out.device).view(out.shape), samples1, samples2, out=out)
+    else:
+        raise ValueError(f"Unknown blend mode: {mode}")
+
+
+def blend_samples(samples1: torch.Tensor, samples2: torch.Tensor, mode: str, ratio: float, seed: int, chunk_elements: int = blend_chunk_elements) -> torch.Tensor:
+    """Blend the two tensors, broadcasting them against each other.
+
+    The output is on the GPU if either input is, with the promoted dtype. The inputs are converted chunk by chunk.
+    """
+    try:
+        shape = torch.broadcast_shapes(samples1.shape, samples2.shape)
+    except RuntimeError:
+        raise ValueError(f"Shape mismatch: latent1: {samples1.shape} vs latent2: {samples2.shape}")
+    dtype = torch.promote_types(samples1.dtype, samples2.dtype)
+    device = samples1.device if samples1.device.type != "cpu" else samples2.device
+
+    if mode not in blend_choice: raise ValueError(f"Unknown blend mode: {mode}")
+
+    out = torch.empty(shape, dtype=dtype, device=device)
+    # Broadcasting with views, nothing is materialized.
+    samples1, samples2 = samples1.expand(shape), samples2.expand(shape)
+
+    # Chunk along the outermost dim that is not 1 (batch, or channels for a single video), so the chunks of the output are contiguous.
+    dim = next((d for d in range(max(1, out.dim() - 2)) if out.shape[d] > 1), 0) if out.dim() > 0 else None
+    if dim is None or out.numel() == 0:
+        _blend_into(out, samples1.to(device, dtype), samples2.to(device, dtype), mode, ratio, seed, 0)
+        return out
+    step = max(1, chunk_elements * out.shape[dim] // out.numel())
+    for start in range(0, out.shape[dim], step):
+        n = min(step, out.shape[dim] - start)
+        # Only the chunk is copied if the device or dtype need to change.
+        _blend_into(out.narrow(dim, start, n), samples1.narrow(dim, start, n).to(device, dtype), samples2.narrow(dim, start, n).to(device, dtype),
+                    mode, ratio, seed, start * out.stride(dim))
+    return out
+
+
 class LTBlendLatent:
     @classmethod
     def INPUT_TYPES(cls):
@@ -24,34 +100,113 @@ class LTBlendLatent:
 
     def blend(self, latent1: dict, latent2: dict, mode: str, ratio: float, seed: int) -> tuple[dict, ...]:
         assert isinstance(latent1, dict) and isinstance(latent2, dict), "Inputs must be dictionaries"
-        samples1, samples2 = latent1["samples"], latent2["samples"]
+        # Lazy noise is generated directly on the device of the other latent.
+        device = next((latent["samples"].device for latent in (latent1, latent2) if "samples" in latent), None)
+        samples1, samples2 = latent_samples(latent1, device), latent_samples(latent2, device)
 
         assert isinstance(samples1, torch.Tensor), "latent1['samples'] must be torch.Tensor"
         assert isinstance(samples2, torch.Tensor), "latent2['samples'] must be torch.Tensor"
 
-        assert samples1.shape == samples2.shape, f"Shape mismatch: latent1: {samples1.shape} vs latent2: {samples2.shape}"
-
-        if mode == "interpolate":
-            blended = samples1 * ratio + samples2 * (1 - ratio)
-        elif mode == "add":
-            blended = samples1 + samples2
-        elif mode == "multiply":
-            blended = samples1 * samples2
-        elif mode == "abs_max":
-            blended = torch.where(torch.abs(samples1) > torch.abs(samples2), samples1, samples2)
-        elif mode == "abs_min":
-            blended = torch.where(torch.abs(samples1) < torch.abs(samples2), samples1, samples2)
-        elif mode == "max":
-            blended = torch.maximum(samples1, samples2)
-        elif mode == "min":
-            blended = torch.minimum(samples1, samples2)
-        elif mode == "sample":
-            torch.manual_seed(seed)
-            mask = torch.rand_like(samples1) >= ratio
-            blended = torch.where(mask, samples1, samples2)
-        else:
-            raise ValueError(f"Unknown blend mode: {mode}")
-
-        return ({"samples": blended},)
+        return ({"samples": blend_samples(samples1, samples2, mode, ratio, seed)},)
+
+
+blend_schedules = ["linear", "slerp", "weights"]
+max_blend_inputs = 8
+
+
+def parse_weights(text: str) -> torch.Tensor:
+    """"1 0; 0.5 0.5; 0 1" (or one row per line) -> T x K weights"""
+    rows = [row.replace(",", " ").split() for row in text.replace(";", "\n").splitlines()]
+    rows = [row for row in rows if row]
+    if not rows: raise ValueError("No weights. Expected one row of weights per output, one weight per latent")
+    if any(len(row) != len(rows[0]) for row in rows): raise ValueError(f"All rows of weights must have the same length: {text}")
+    return torch.tensor([[float(v) for v in row] for row in rows], dtype=torch.float64)
+
+
+def schedule_weights(samples: torch.Tensor, schedule: str, steps: int) -> torch.Tensor:
+    """B x T x K weights that go through the K keyframes samples (K, B, ...) in steps outputs, linearly or along great circles"""
+    k, b = samples.shape[:2]
+    # Output t falls at position p between keyframe i and i + 1.
+    p = torch.linspace(0, k - 1, steps, dtype=torch.float64) if steps > 1 else torch.zeros(1, dtype=torch.float64)
+    i = p.floor().long().clamp(max=max(0, k - 2))
+    s = (p - i)[None].expand(b, steps)
+    w0, w1 = 1 - s, s
 
+    if schedule == "slerp" and k > 1:
+        # The angle between consecutive keyframes, per batch item.
+        flat = samples.reshape(k, b, -1).double()
+        dot = (flat[:-1] * flat[1:]).sum(-1) / (flat[:-1].norm(dim=-1) * flat[1:].norm(dim=-1)).clamp(min=1e-12)
+        omega = dot.clamp(-1, 1).acos().T[:, i]  # B x T
+        sin = omega.sin()
+        # Nearly parallel keyframes: slerp is linear anyway.
+        spherical = sin > 1e-6
+        w0 = torch.where(spherical, ((1 - s) * omega).sin() / sin.clamp(min=1e-6), w0)
+        w1 = torch.where(spherical, (s * omega).sin() / sin.clamp(min=1e-6), w1)
+    elif schedule not in ("linear", "slerp"):
+        raise ValueError(f"Unknown schedule: {schedule}. Expected one of {blend_schedules}")
 
+    weights = torch.zeros(b, steps, k, dtype=torch.float64)
+    t = torch.arange(steps)
+    weights[:, t, i] = w0
+    if k > 1: weights[:, t, (i + 1).clamp(max=k - 1)] += w1
+    return weights
+
+
+def blend_weighted(latents: list[torch.Tensor], schedule: str, steps: int, weights: str = "") -> torch.Tensor:
+    """All the T blends of the K latents in one einsum. The output batch is T x B, output-major"""
+    shape = latents[0].shape
+    for i, x in enumerate(latents[1:], 2):
+        if x.shape != shape: raise ValueError(f"Shape mismatch: latent1: {list(shape)} vs latent{i}: {list(x.shape)}")
+    device = next((x.device for x in latents if x.device.type != "cpu"), latents[0].device)
+    dtype = latents[0].dtype
+    for x in latents[1:]: dtype = torch.promote_types(dtype, x.dtype)
+    # Half precision sums are not accurate enough.
+    compute_dtype = torch.promote_types(dtype, torch.float32)
+    samples = torch.stack([x.to(device, compute_dtype) for x in latents])  # K, B, ...
+
+    if schedule == "weights":
+        w = parse_weights(weights)
+        if w.shape[1] != len(latents): raise ValueError(f"The weights have {w.shape[1]} columns, expected one per latent ({len(latents)})")
+        w = w[None].expand(shape[0], -1, -1)
+    else:
+        w = schedule_weights(samples, schedule, steps)
+
+    out = torch.einsum("btk,kb...->tb...", w.to(device, compute_dtype), samples)
+    return out.reshape(-1, *shape[1:]).to(dtype)
+
+
+class LTBlendLatentSchedule:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "latent1": ("LATENT", {}),
+                "latent2": ("LATENT", {}),
+                "schedule": (blend_schedules, {"default": "slerp", "tooltip": "linear/slerp: steps outputs going through the latents in order. slerp keeps the norm of Gaussian noise. weights: one output per row of weights"}),
+                "steps": ("INT", {"default": 16, "min": 1, "max": 10000, "tooltip": "The number of outputs for linear and slerp"}),
+                "weights": ("STRING", {"default": "1 0\n0.5 0.5\n0 1", "multiline": True, "tooltip": "For schedule=weights: one row per output, with one weight per connected latent"}),
+            },
+            "optional": {f"latent{i}": ("LATENT", {}) for i in range(3, max_blend_inputs + 1)}
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = f"Blend up to {max_blend_inputs} latents into a batch of interpolations or weighted sums"
+    FUNCTION = "blend"
+    RETURN_TYPES = ("LATENT", )
+
+    def blend(self, latent1: dict, latent2: dict, schedule: str, steps: int, weights: str, **latents) -> tuple[dict, ...]:
+        inputs = [latent1, latent2] + [latents[f"latent{i}"] for i in range(3, max_blend_inputs + 1) if latents.get(f"latent{i}") is not None]
+        assert all(isinstance(latent, dict) for latent in inputs), "Inputs must be dictionaries"
+        # Lazy noise is generated directly on the device of the other latents.
+        device = next((latent["samples"].device for latent in inputs if "samples" in latent), None)
+        samples = [latent_samples(latent, device) for latent in inputs]
+        return ({"samples": blend_weighted(samples, schedule, steps, weights)},)
+
+    @classmethod
+    def VALIDATE_INPUTS(cls, schedule, weights):
+        if schedule == "weights":
+            try:
+                parse_weights(weights)
+            except ValueError as e:
+                return str(e)
+        return True
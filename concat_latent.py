@@ -1,4 +1,59 @@
 import torch
+import logging
+
+from .noise import latent_samples
+
+max_inputs = 16
+
+
+def _repeat_to_batch(mask: torch.Tensor, batch_size: int) -> torch.Tensor:
+    if mask.shape[0] == batch_size: return mask
+    return mask.repeat((batch_size + mask.shape[0] - 1) // mask.shape[0], *[1] * (mask.dim() - 1))[:batch_size]
+
+
+def concat_latents(latents: list[dict], dim: int) -> dict:
+    """Concatenate the latents along dim into one output, with their noise_mask and batch_index"""
+    assert len(latents) > 0, "Nothing to concatenate"
+    for i, latent in enumerate(latents):
+        assert isinstance(latent, dict), f"Incorrect type for latent {i + 1}: Expected dict, got {type(latent)}"
+    samples = [latent_samples(latent) for latent in latents]
+    for i, x in enumerate(samples):
+        assert isinstance(x, torch.Tensor), f"Incorrect type for latent {i + 1}.samples: Expected torch.Tensor, got {type(x).__name__}"
+
+    # The video models have weird number of dimensions. As long as the numbers match, just let it be.
+    ndim = samples[0].dim()
+    if not -ndim <= dim < ndim: raise ValueError(f"dim {dim} is out of range for {ndim} dimensions")
+    dim = dim % ndim
+    for i, x in enumerate(samples[1:], 2):
+        if x.dim() != ndim:
+            raise ValueError(f"Dimension mismatch: latent 1 has {ndim} dimensions, latent {i} has {x.dim()} dimensions")
+        if x.shape[:dim] + x.shape[dim + 1:] != samples[0].shape[:dim] + samples[0].shape[dim + 1:]:
+            raise ValueError(f"Shape mismatch: latent 1 is {list(samples[0].shape)}, latent {i} is {list(x.shape)}, they can only differ in dim {dim}")
+
+    # torch.cat writes every input into a single preallocated output. It also promotes the dtypes.
+    device = samples[0].device
+    out = {"samples": torch.cat([x.to(device) for x in samples], dim=dim)}
+
+    masks = [latent.get("noise_mask", None) for latent in latents]
+    if any(m is not None for m in masks):
+        if dim == 0:
+            # Items without a mask are not masked.
+            first = next(m for m in masks if m is not None)
+            masks = [_repeat_to_batch(m, x.shape[0]) if m is not None else torch.ones(x.shape[0], *first.shape[1:], device=first.device) for m, x in zip(masks, samples)]
+            if any(m.shape[1:] != first.shape[1:] for m in masks):
+                raise ValueError(f"noise_mask shape mismatch: {[list(m.shape) for m in masks]}")
+            out["noise_mask"] = torch.cat([m.to(first.device) for m in masks])
+        elif all(m is masks[0] or (m is not None and masks[0] is not None and torch.equal(m, masks[0])) for m in masks):
+            out["noise_mask"] = masks[0]
+        else:
+            logging.warning(f"LTLatentsConcatenate: The inputs have different noise masks, which can't be concatenated along dim {dim}. Dropping them")
+
+    if dim == 0 and any("batch_index" in latent for latent in latents):
+        # Like ComfyUI's LatentBatch.
+        out["batch_index"] = [i for latent, x in zip(latents, samples) for i in latent.get("batch_index", range(x.shape[0]))]
+
+    return out
+
 
 class LTLatentsConcatenate:
     @classmethod
@@ -8,30 +63,35 @@ class LTLatentsConcatenate:
                 "latent1": ("LATENT", {}),
                 "latent2": ("LATENT", {}),
                 "dim": ("INT", {"min":-10, "max": 10, "default":-4})
+            },
+            "optional": {f"latent{i}": ("LATENT", {}) for i in range(3, max_inputs + 1)}
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = f"Concatenate up to {max_inputs} latents along a given dimension"
+    FUNCTION = "concat"
+    RETURN_TYPES = ("LATENT", )
+
+    def concat(self, latent1: dict, latent2: dict, dim:int, **latents):
+        extra = [latents[f"latent{i}"] for i in range(3, max_inputs + 1) if latents.get(f"latent{i}") is not None]
+        return (concat_latents([latent1, latent2] + extra, dim),)
+
+
+class LTLatentsConcatenateList:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "latents": ("LATENT", {"tooltip": "A list of latents, e.g. from a node that outputs a list"}),
+                "dim": ("INT", {"min":-10, "max": 10, "default":-4})
             }
         }
 
+    INPUT_IS_LIST = True
     CATEGORY = "LatentTools"
-    DESCRIPTION = "Concatenate two latents along a given dimension"
+    DESCRIPTION = "Concatenate a list of latents along a given dimension"
     FUNCTION = "concat"
     RETURN_TYPES = ("LATENT", )
 
-    def concat(self, latent1: dict, latent2: dict, dim:int):
-        assert isinstance(latent1, dict), f"Incorrect type for latent1: Expected dict, got {type(latent1)}"
-        assert isinstance(latent2, dict), f"Incorrect type for latent2: Expected dict, got {type(latent2)}"
-        samples1 = latent1["samples"]
-        samples2 = latent2["samples"]
-        assert isinstance(samples1, torch.Tensor), f"Incorrect type for latent1.samples: Expected torch.Tensor, got {type(samples1).__name__}"
-        assert isinstance(samples2, torch.Tensor), f"Incorrect type for latent2.samples: Expected torch.Tensor, got {type(samples2).__name__}"
-        
-        # Validate dimensions
-        if samples1.dim() != samples2.dim():
-            raise ValueError(f"Dimension mismatch: latent1 has {samples1.dim()} dimensions, latent2 has {samples2.dim()} dimensions")
-
-        # The video models have weird number of dimensions. As long as the numbers match, just let it be.
-        # if samples1.dim() < 4: raise ValueError(f"latent1 should have 4 dimensions, got {samples1.dim()} dimensions")
-        # if samples2.dim() != 4: raise ValueError(f"latent2 should have 4 dimensions, got {samples2.dim()} dimensions")
-
-        concatenated = torch.cat([samples1, samples2], dim=dim)
-
-        return ({"samples": concatenated},)
\ No newline at end of file
+    def concat(self, latents: list[dict], dim: list[int]):
+        return (concat_latents(latents, dim[0]),)
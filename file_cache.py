@@ -0,0 +1,167 @@
+import os
+import time
+import hashlib
+import threading
+import torch
+from collections import OrderedDict
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+_chunk_size = 8 * 1024 * 1024
+
+
+def _hash_name(hash_mode: str) -> str:
+    """The hash that is actually used for hash_mode"""
+    # xxhash is an optional dependency, blake2b is the fastest cryptographic hash in hashlib.
+    if hash_mode == "xxhash": return "xxh3_128" if xxhash is not None else "blake2b"
+    if hash_mode in ("blake2b", "sha256"): return hash_mode
+    raise ValueError(f"Unknown hash_mode: {hash_mode}. Expected one of ['xxhash', 'blake2b', 'sha256']")
+
+
+def _new_hash(hash_mode: str):
+    name = _hash_name(hash_mode)
+    if name == "xxh3_128": return xxhash.xxh3_128()
+    if name == "sha256": return hashlib.sha256()
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_file(file_path: str, hash_mode: str = "xxhash") -> str:
+    h = _new_hash(hash_mode)
+    buf = bytearray(_chunk_size)
+    view = memoryview(buf)
+    with open(file_path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+# abspath -> ((size, mtime_ns, inode, hash), digest)
+_fingerprints: dict[str, tuple[tuple, str]] = {}
+_fingerprints_lock = threading.Lock()
+
+
+def file_fingerprint(file_path: str, hash_mode: str = "xxhash") -> str:
+    """Content hash of a file. The file is only re-hashed when its size, mtime or inode change"""
+    path = os.path.abspath(file_path)
+    st = os.stat(path)
+    # Keyed on the hash that's used, not the one that was asked for.
+    key = (st.st_size, st.st_mtime_ns, st.st_ino, _hash_name(hash_mode))
+
+    with _fingerprints_lock:
+        cached = _fingerprints.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    digest = hash_file(path, hash_mode)
+    with _fingerprints_lock:
+        _fingerprints[path] = (key, digest)
+    return digest
+
+
+class DirectoryIndex:
+    """Recursive list of the files with the given extensions under a directory.
+
+    Every call only stats the directories. A directory is listed again (with os.scandir) only when its mtime changes,
+    which happens when entries are added, removed or renamed in it.
+    """
+
+    # Directory mtimes more recent than this can still change within the same timestamp tick (FAT has 2s resolution).
+    _settle_ns = 2_000_000_000
+
+    def __init__(self, extensions: tuple[str, ...]):
+        self.extensions = extensions
+        # path -> (mtime_ns, files, subdirectories)
+        self._dirs: dict[str, tuple[int, list[str], list[str]]] = {}
+        self._lock = threading.Lock()
+
+    def _list(self, path: str) -> tuple[list[str], list[str]]:
+        files, subdirs = [], []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    # Like os.walk, don't follow symlinks to directories.
+                    if entry.is_dir(follow_symlinks=False): subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(self.extensions) and entry.is_file(): files.append(entry.path)
+        except OSError:
+            pass
+        return files, subdirs
+
+    def _scan(self, path: str, seen: set[str], result: list[str]):
+        seen.add(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return
+
+        cached = self._dirs.get(path)
+        if cached is None or cached[0] != mtime:
+            files, subdirs = self._list(path)
+            # Don't trust an mtime that can still change without us noticing, list the directory again next time.
+            stable = time.time_ns() - mtime > self._settle_ns
+            cached = self._dirs[path] = (mtime if stable else -1, files, subdirs)
+
+        result.extend(cached[1])
+        for d in cached[2]:
+            self._scan(d, seen, result)
+
+    def files(self, root: str) -> list[str]:
+        with self._lock:
+            seen, result = set(), []
+            self._scan(root, seen, result)
+            # Forget directories that have been removed.
+            for path in self._dirs.keys() - seen:
+                del self._dirs[path]
+        return result
+
+
+class TensorCache:
+    """Thread-safe LRU of tensors, bounded by their total size in bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            tensor = self._items.get(key)
+            if tensor is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return tensor
+
+    def put(self, key, tensor):
+        # Don't flush the whole cache for a tensor that won't fit anyway.
+        if tensor.nbytes > self.max_bytes: return
+        with self._lock:
+            if key in self._items: self.bytes -= self._items.pop(key).nbytes
+            self._items[key] = tensor
+            self.bytes += tensor.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def stats(self) -> str:
+        return (f"{len(self._items)} items, {self.bytes / (1024 * 1024):.1f}/{self.max_bytes / (1024 * 1024):.0f} MiB, "
+                f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions")
+
+
+def tensor_fingerprint(x: torch.Tensor, *extra) -> str:
+    """Hash of a tensor's shape, dtype and contents, and any extra values that affect what's derived from it"""
+    h = _new_hash("xxhash")
+    h.update(repr((tuple(x.shape), str(x.dtype), extra)).encode())
+    # Any dtype can be viewed as bytes, including the ones numpy does not have.
+    h.update(memoryview(x.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()))
+    return h.hexdigest()
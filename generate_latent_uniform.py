@@ -1,4 +1,4 @@
-import torch
+from .noise import noise_latent, rng_options, seed_modes, dtype_options, device_options, get_device
 
 class LTRandomUniform:
     @classmethod
@@ -14,6 +14,13 @@ class LTRandomUniform:
                 "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff,
                     "control_after_generate": True,
                     "tooltip": "The random seed used for creating the noise."}),
+                "rng": (rng_options, {"default": rng_options[0], "tooltip": "cpu: the sequential CPU generator. philox: a counter-based generator, generated in parallel directly on the device and in the dtype"}),
+                "dtype": (list(dtype_options), {"default": "fp32"}),
+                "device": (device_options, {"default": device_options[0]}),
+                "seed_mode": (seed_modes, {"default": seed_modes[0], "tooltip": "batch: one random sequence for the whole batch. per_item: item k uses seed + k, and does not depend on the other items"}),
+                "start_index": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "tooltip": "Only generate the batch items starting from this one"}),
+                "count": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "tooltip": "Number of batch items to generate, 0 for all the remaining ones"}),
+                "lazy": ("BOOLEAN", {"default": False, "tooltip": "Output a description of the noise, and only generate it in the LatentTools node that uses it, on the device and for the batch items it needs"}),
             },
         }
 
@@ -23,8 +30,9 @@ class LTRandomUniform:
     FUNCTION = "random_uniform"
     OUTPUT_NODE = True
 
-    def random_uniform(self, channels: int, width: int, height: int, batch_size: int, min: float, max: float, seed: int):
-        generator = torch.Generator()
-        generator.manual_seed(seed)
-        samples = torch.rand(batch_size, channels, height//8, width//8, generator=generator) * (max - min) + min
-        return ({"samples": samples},)
\ No newline at end of file
+    def random_uniform(self, channels: int, width: int, height: int, batch_size: int, min: float, max: float, seed: int,
+                       rng: str = "cpu", dtype: str = "fp32", device: str = "cpu",
+                       seed_mode: str = "batch", start_index: int = 0, count: int = 0, lazy: bool = False):
+        latent = noise_latent((batch_size, channels, height//8, width//8), "uniform", seed, max - min, min, rng,
+                              dtype_options[dtype], get_device(device), seed_mode, start_index, count, lazy)
+        return (latent,)
\ No newline at end of file
@@ -0,0 +1,224 @@
+import io
+import os
+import math
+import json
+import logging
+import zipfile
+import torch
+import numpy as np
+from safetensors import safe_open
+from safetensors.torch import save_file, save as safetensors_save, load as safetensors_load
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+tensor_extensions = (".pt", ".safetensors", ".npy", ".npz")
+# Any of the formats compressed with zstd, and the index of a sharded batch.
+latent_extensions = tensor_extensions + tuple(ext + ".zst" for ext in tensor_extensions) + (".index.json",)
+
+# Tensor names we look for in multi-tensor files, in order of preference.
+sample_keys = ("samples", "latent_tensor", "arr_0")
+
+
+def _pick_key(keys: list[str], file_path: str) -> str:
+    for k in sample_keys:
+        if k in keys: return k
+    if len(keys) == 1: return keys[0]
+    raise ValueError(f"Can't find the latent in {file_path}. Expected one of {sample_keys} or a single tensor, got {keys}")
+
+
+def _slices(shape, batch_index: int, channel_start: int, channel_count: int) -> tuple[slice, ...]:
+    """Index for a stored latent of `shape`, which is either BC... or a single CHW latent"""
+    channels = shape[0] if len(shape) == 3 else shape[1]
+    if channel_start >= channels: raise ValueError(f"channel_start={channel_start} is out of range for {channels} channels")
+    chans = slice(channel_start, channel_start + channel_count if channel_count > 0 else channels)
+
+    if len(shape) == 3:
+        if batch_index > 0: raise ValueError(f"batch_index={batch_index} is out of range for a single latent")
+        return (chans,)
+
+    if batch_index >= shape[0]: raise ValueError(f"batch_index={batch_index} is out of range for batch size {shape[0]}")
+    batch = slice(batch_index, batch_index + 1) if batch_index >= 0 else slice(None)
+    return (batch, chans)
+
+
+def _read_pt(file_path, load_mode, batch_index, channel_start, channel_count) -> torch.Tensor:
+    if load_mode == "mmap":
+        try:
+            samples = torch.load(file_path, mmap=True, weights_only=True, map_location="cpu")
+        except RuntimeError as e:
+            # Files saved with the legacy (non-zip) serialization can't be memory-mapped.
+            logging.warning(f"LTLatentLoad: Can't mmap {file_path}, falling back to a full load: {e}")
+            samples = torch.load(file_path)
+    else:
+        samples = torch.load(file_path)
+
+    # Either a plain tensor or a dict with ["samples"]: Tensor
+    if isinstance(samples, dict) and "samples" in samples:
+        samples = samples["samples"]
+    elif not isinstance(samples, torch.Tensor):
+        raise ValueError("Unexpected format in PT file.")
+
+    # With mmap, this is a view and only the selected part will be paged in.
+    selected = samples[_slices(samples.shape, batch_index, channel_start, channel_count)]
+    # Otherwise, don't keep the whole file in memory for a part of it.
+    if load_mode != "mmap" and selected.numel() != samples.numel(): selected = selected.clone()
+    return selected
+
+
+def _read_safetensors(file_path, batch_index, channel_start, channel_count) -> torch.Tensor:
+    # safetensors only reads the header and the byte ranges of the requested slice.
+    with safe_open(file_path, framework="pt", device="cpu") as f:
+        sl = f.get_slice(_pick_key(list(f.keys()), file_path))
+        return sl[_slices(sl.get_shape(), batch_index, channel_start, channel_count)]
+
+
+def _read_npy_stream(f, batch_index) -> np.ndarray | None:
+    """Read a batch range from an .npy stream without reading the rest. Returns None if the layout does not allow it"""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+    if fortran_order or dtype.hasobject: return None
+    # The same batch_index checks as the other formats, including for a single latent.
+    _slices(shape, batch_index, 0, 0)
+
+    # A single latent, or the whole batch.
+    if len(shape) == 3 or batch_index < 0:
+        count = math.prod(shape)
+        return np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count).reshape(shape)
+
+    row = math.prod(shape[1:])
+    f.seek(f.tell() + batch_index * row * dtype.itemsize)
+    return np.frombuffer(f.read(row * dtype.itemsize), dtype=dtype, count=row).reshape((1, *shape[1:]))
+
+
+def _read_npz(file_path, batch_index, channel_start, channel_count) -> np.ndarray:
+    with zipfile.ZipFile(file_path) as zf:
+        key = _pick_key([n.removesuffix(".npy") for n in zf.namelist()], file_path)
+        with zf.open(key + ".npy") as f:
+            arr = _read_npy_stream(f, batch_index)
+
+    if arr is None:
+        with np.load(file_path) as npz: arr = npz[key]
+        return arr[_slices(arr.shape, batch_index, channel_start, channel_count)]
+
+    # The batch has already been selected while reading.
+    return arr[_slices(arr.shape, -1, channel_start, channel_count)]
+
+
+def _zstd():
+    if zstandard is None: raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+    return zstandard
+
+
+def _read_zst(file_path, batch_index, channel_start, channel_count) -> torch.Tensor:
+    # A compressed file has to be decompressed as a whole anyway.
+    buf = io.BytesIO()
+    with open(file_path, "rb") as f:
+        _zstd().ZstdDecompressor().copy_stream(f, buf)
+    buf.seek(0)
+
+    ext = os.path.splitext(file_path[:-len(".zst")])[1].lower()
+    if ext == ".pt":
+        samples = torch.load(buf, weights_only=True)
+        if isinstance(samples, dict) and "samples" in samples: samples = samples["samples"]
+        elif not isinstance(samples, torch.Tensor): raise ValueError("Unexpected format in PT file.")
+    elif ext == ".safetensors":
+        tensors = safetensors_load(buf.getvalue())
+        samples = tensors[_pick_key(list(tensors), file_path)]
+    elif ext == ".npy":
+        samples = torch.from_numpy(np.load(buf))
+    elif ext == ".npz":
+        with np.load(buf) as npz: samples = torch.from_numpy(npz[_pick_key(list(npz.keys()), file_path)])
+    else:
+        raise ValueError(f"Unsupported latent file format: {file_path}. Expected one of {latent_extensions}")
+
+    selected = samples[_slices(samples.shape, batch_index, channel_start, channel_count)]
+    return selected.clone() if selected.numel() != samples.numel() else selected
+
+
+def _read_index(file_path, load_mode, batch_index, channel_start, channel_count) -> torch.Tensor:
+    with open(file_path) as f: index = json.load(f)
+    root = os.path.dirname(file_path)
+    shards = index["shards"]
+
+    if batch_index >= 0:
+        # Only the shard with the item is read.
+        for shard in shards:
+            if shard["start"] <= batch_index < shard["start"] + shard["count"]:
+                return read_latent(os.path.join(root, shard["file"]), load_mode, batch_index - shard["start"], channel_start, channel_count)
+        raise ValueError(f"batch_index={batch_index} is out of range for batch size {index['shape'][0]}")
+
+    parts = [read_latent(os.path.join(root, shard["file"]), load_mode, -1, channel_start, channel_count) for shard in shards]
+    return torch.cat(parts) if len(parts) > 1 else parts[0]
+
+
+def read_latent(file_path: str, load_mode: str = "full", batch_index: int = -1, channel_start: int = 0, channel_count: int = 0) -> torch.Tensor:
+    """Read a latent tensor, only decoding the selected batch item (-1 for all) and channel range (count 0 for all)"""
+    if file_path.lower().endswith(".index.json"):
+        return _read_index(file_path, load_mode, batch_index, channel_start, channel_count)
+    if file_path.lower().endswith(".zst"):
+        return _read_zst(file_path, batch_index, channel_start, channel_count)
+
+    ext = os.path.splitext(file_path)[1].lower()
+
+    if ext == ".pt":
+        return _read_pt(file_path, load_mode, batch_index, channel_start, channel_count)
+    if ext == ".safetensors":
+        return _read_safetensors(file_path, batch_index, channel_start, channel_count)
+    if ext == ".npy":
+        arr = np.load(file_path, mmap_mode="r" if load_mode == "mmap" else None)
+        # Copy just the selected part out of the (possibly read-only) memory map.
+        return torch.from_numpy(np.array(arr[_slices(arr.shape, batch_index, channel_start, channel_count)]))
+    if ext == ".npz":
+        return torch.from_numpy(np.array(_read_npz(file_path, batch_index, channel_start, channel_count)))
+
+    raise ValueError(f"Unsupported latent file format: {file_path}. Expected one of {latent_extensions}")
+
+
+def _encode(ext: str, samples: torch.Tensor) -> bytes:
+    buf = io.BytesIO()
+    if ext == ".pt": torch.save({"samples": samples}, buf)
+    elif ext == ".safetensors": return safetensors_save({"samples": samples})
+    elif ext == ".npy": np.save(buf, samples.numpy())
+    elif ext == ".npz": np.savez(buf, samples=samples.numpy())
+    return buf.getvalue()
+
+
+def write_latent(file_path: str, samples: torch.Tensor, level: int = 3):
+    """Write samples to a .pt, .safetensors, .npy or .npz file. With .zst added to the name, compress it with zstd at level"""
+    compressed = file_path.lower().endswith(".zst")
+    ext = os.path.splitext(file_path[:-len(".zst")] if compressed else file_path)[1].lower()
+    if ext not in tensor_extensions:
+        raise ValueError(f"Unsupported latent file format: {file_path}. Expected one of {latent_extensions}")
+
+    samples = samples.detach().cpu().contiguous()
+    # torch.save writes the whole storage, not just the part a slice (e.g. a shard of a batch) uses.
+    if samples.untyped_storage().nbytes() != samples.nbytes: samples = samples.clone()
+    # Numpy has no bfloat16
+    if ext in (".npy", ".npz") and samples.dtype == torch.bfloat16: samples = samples.to(torch.float32)
+
+    if compressed:
+        data = _encode(ext, samples)
+        with open(file_path, "wb") as f:
+            _zstd().ZstdCompressor(level=level, threads=-1).copy_stream(io.BytesIO(data), f, size=len(data))
+    elif ext == ".pt":
+        torch.save({"samples": samples}, file_path)
+    elif ext == ".safetensors":
+        save_file({"samples": samples}, file_path)
+    elif ext == ".npy":
+        np.save(file_path, samples.numpy())
+    else:
+        np.savez(file_path, samples=samples.numpy())
+
+
+def write_index(file_path: str, shards: list[tuple[str, int, int]], shape: list[int], dtype: torch.dtype):
+    """The index of a batch sharded into (file, start, count) files, relative to the index"""
+    index = {"shape": list(shape), "dtype": str(dtype).removeprefix("torch."),
+             "shards": [{"file": os.path.basename(file), "start": start, "count": count} for file, start, count in shards]}
+    with open(file_path, "w") as f: json.dump(index, f, indent=1)
@@ -1,7 +1,48 @@
+import re
+import types
 import torch
 import lovely_tensors as lt
+from typing import Callable
+from functools import lru_cache
+from collections import OrderedDict
+
+from .normalize import normalize, normalize_dims
+from .noise import latent_samples
 
 ops = ["add", "mul", "pow", "exp", "abs", "clamp_bottom", "clamp_top", "norm", "mean", "std", "sigmoid", "nop"]
+no_arg_ops = ["exp", "abs", "norm", "sigmoid", "nop"]
+
+
+def apply_op(samples: torch.Tensor, op: str, arg: float, inplace: bool = False) -> torch.Tensor:
+    """Apply one of the ops. With inplace=True, samples is modified - only use it on tensors nobody else holds"""
+    if op == "add":
+        samples = samples.add_(arg) if inplace else samples + arg
+    elif op == "mul":
+        samples = samples.mul_(arg) if inplace else samples * arg
+    elif op == "pow":
+        samples = samples.pow_(arg) if inplace else samples ** arg
+    elif op == "exp":
+        samples = samples.exp_() if inplace else torch.exp(samples)
+    elif op == "abs":
+        samples = samples.abs_() if inplace else torch.abs(samples)
+    elif op == "clamp_bottom":
+        samples = samples.clamp_(min=arg) if inplace else torch.clamp(samples, min=arg)
+    elif op == "clamp_top":
+        samples = samples.clamp_(max=arg) if inplace else torch.clamp(samples, max=arg)
+    elif op == "norm":
+        samples = normalize(samples, normalize_dims(samples, "all"), inplace=inplace)
+    elif op == "mean":
+        samples = samples.sub_(samples.mean() - arg) if inplace else samples - (samples.mean() - arg)
+    elif op == "std":
+        samples = samples.mul_(arg / samples.std()) if inplace else samples * (arg / samples.std())
+    elif op == "sigmoid":
+        samples = samples.sigmoid_() if inplace else torch.sigmoid(samples)
+    elif op == "nop":
+        pass
+    else:
+        raise ValueError(f"Unknown operation: {op}")
+    return samples
+
 
 class LTLatentOp:
     @classmethod
@@ -21,35 +62,101 @@ class LTLatentOp:
 
     def op(self, latent: dict, op: str, arg: float):
         assert isinstance(latent, dict), "latent must be a dict"
-        samples = latent["samples"]
-
-        if op == "add":
-            samples = samples + arg
-        elif op == "mul":
-            samples = samples * arg
-        elif op == "pow":
-            samples = samples ** arg
-        elif op == "exp":
-            samples = torch.exp(samples)
-        elif op == "abs":
-            samples = torch.abs(samples)
-        elif op == "clamp_bottom":
-            samples = torch.clamp(samples, min=arg)
-        elif op == "clamp_top":
-            samples = torch.clamp(samples, max=arg)
-        elif op == "norm":
-            samples = (samples - samples.mean()) / samples.std()
-        elif op == "mean":
-            samples = samples - samples.mean() + arg
-        elif op == "std":
-            samples = (samples * arg) / samples.std()
-        elif op == "sigmoid":
-            samples = torch.sigmoid(samples)
-        elif op == "nop":
-            pass
+        samples = latent_samples(latent)
+
+        return ({"samples": apply_op(samples, op, arg)},)
+
+
+@lru_cache(maxsize=256)
+def parse_expression(expression: str) -> tuple[tuple[str, float], ...]:
+    """Parse "norm | mul 0.5 | clamp_top 2 | sigmoid" into ((op, arg), ...)"""
+    steps = []
+    for step in expression.split("|"):
+        m = re.fullmatch(r"\s*([a-z_]+)\s*(\S+)?\s*", step)
+        if m is None or m[1] not in ops:
+            raise ValueError(f"Invalid step '{step.strip()}' in '{expression}'. Expected one of {ops}, followed by an argument")
+        op, arg = m[1], m[2]
+        if (arg is None) != (op in no_arg_ops):
+            raise ValueError(f"'{op}' {'takes no' if op in no_arg_ops else 'needs an'} argument in '{expression}'")
+        steps.append((op, float(arg) if arg is not None else 0.))
+    return tuple(steps)
+
+
+def _run_ops(samples: torch.Tensor, structure: tuple[str, ...], args) -> torch.Tensor:
+    # The first step creates the output, the rest of the steps modify it in place.
+    first, *rest = structure
+    samples = apply_op(samples, first, args[0])
+    if first == "nop": samples = samples.clone()
+    for i, op in enumerate(rest, 1):
+        samples = apply_op(samples, op, args[i], inplace=True)
+    return samples
+
+
+def _run_expression(samples: torch.Tensor, steps: tuple[tuple[str, float], ...]) -> torch.Tensor:
+    return _run_ops(samples, tuple(op for op, _ in steps), [arg for _, arg in steps])
+
+
+def _ops_function(structure: tuple[str, ...]) -> Callable:
+    def run(samples, args):
+        return _run_ops(samples, structure, args)
+    # Dynamo keeps its compiled graphs, guards and recompile limit per code object. With a shared code object, every
+    # expression and shape would count towards the same limit, and the rest would silently run eagerly.
+    code = run.__code__.replace(co_name=f"expr_{'_'.join(structure)}")
+    return types.FunctionType(code, run.__globals__, code.co_name, None, run.__closure__)
+
+
+# (ops, shape, dtype, device) -> compiled function, least recently used first
+_compiled: OrderedDict[tuple, Callable] = OrderedDict()
+_max_compiled = 64
+
+def compiled_expression(expression: str, samples: torch.Tensor) -> Callable:
+    """The compiled expression for the shape, dtype and device of samples. Call it with samples.
+
+    Only the ops are compiled in, their arguments are passed as a tensor, so changing them does not recompile.
+    """
+    steps = parse_expression(expression)
+    structure = tuple(op for op, _ in steps)
+    key = (structure, tuple(samples.shape), samples.dtype, samples.device)
+    fn = _compiled.get(key)
+    if fn is None:
+        fn = _compiled[key] = torch.compile(_ops_function(structure), dynamic=False)
+        if len(_compiled) > _max_compiled: _compiled.popitem(last=False)
+    _compiled.move_to_end(key)
+    args = torch.tensor([arg for _, arg in steps], dtype=torch.float32, device=samples.device)
+    return lambda x: fn(x, args)
+
+
+class LTLatentExpr:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "latent": ("LATENT", {}),
+                "expression": ("STRING", {"default": "norm | mul 0.5 | sigmoid", "tooltip": f"Operations separated by |, applied left to right. One of {ops}, with an argument except for {no_arg_ops}"}),
+                "compile": ("BOOLEAN", {"default": False, "tooltip": "Fuse the operations into a few kernels with torch.compile. The first run for each expression and shape takes a while"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Apply a chain of operations to a latent tensor, with a single allocation"
+    FUNCTION = "expr"
+    RETURN_TYPES = ("LATENT", )
+
+    def expr(self, latent: dict, expression: str, compile: bool):
+        assert isinstance(latent, dict), "latent must be a dict"
+        samples = latent_samples(latent)
+
+        if compile:
+            samples = compiled_expression(expression, samples)(samples)
         else:
-            raise ValueError(f"Unknown operation: {op}")
+            samples = _run_expression(samples, parse_expression(expression))
 
         return ({"samples": samples},)
 
-
+    @classmethod
+    def VALIDATE_INPUTS(cls, expression):
+        try:
+            parse_expression(expression)
+        except ValueError as e:
+            return str(e)
+        return True
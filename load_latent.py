@@ -1,54 +1,99 @@
 import os
+import sys
 import torch
-import hashlib
+import logging
 import folder_paths
 
-
-normalize_options = ["no", "channel", "image"]
+from .latent_io import latent_extensions, read_latent
+from .file_cache import file_fingerprint, DirectoryIndex, TensorCache
+from .normalize import normalize_options, normalize_dims, normalize as normalize_samples
+
+
+load_modes = ["full", "mmap"]
+
+# The input directory can be huge, only re-list the parts of it that have changed.
+_input_index = DirectoryIndex(latent_extensions)
+
+# Decoded latents shared by all loader nodes, keyed by file content and the selected slice.
+# normalize and rand_sign are applied on top, so changing them does not read the file again.
+_decoded_cache = TensorCache(max_bytes=2 * 1024 * 1024 * 1024)
+
+def peak_rss_mib() -> float | None:
+    """Peak resident set size of the process in MiB, or None if the platform does not report it"""
+    try:
+        import resource
+        # ru_maxrss is in KiB on Linux, but in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil  # Windows
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+def rss_mib() -> float | None:
+    """Current resident set size of the process in MiB, or None if the platform does not report it"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil  # macOS, Windows
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        return None
 
 class LTLatentLoad:
     @classmethod
     def INPUT_TYPES(cls):
 
         input_dir = folder_paths.get_input_directory()
-        files = []
-        for root, dirs, fs in os.walk(input_dir):
-            for f in fs:
-                if f.endswith(".pt") and os.path.isfile(os.path.join(root, f)):
-                    rel_path = os.path.relpath(os.path.join(root, f))
-                    files.append(rel_path)
+        files = [os.path.relpath(f) for f in _input_index.files(input_dir)]
 
         return {
             "required": {
                 "file_path": (sorted(files), {"default": "input/latent.pt"}),
-                "normalize": (normalize_options, {"default": normalize_options[0], "tooltip": "Normalize (μ=0, σ=1) either each channel separately, or the latent as a whole"}),
+                "normalize": (normalize_options, {"default": normalize_options[0], "tooltip": "Normalize (μ=0, σ=1) either each channel separately, each latent as a whole, or each video frame"}),
                 "rand_sign": ("BOOLEAN", {"default": False, "tooltip":"Flip the sign of the elements at random"}),
-                "rand_sign_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "control_after_generate": True, "tooltip": "The random seed used to flip the signs"})
+                "rand_sign_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "control_after_generate": True, "tooltip": "The random seed used to flip the signs"}),
+                "load_mode": (load_modes, {"default": load_modes[0], "tooltip": "full: read the whole file into memory. mmap: memory-map the file and only page in the data that is actually used"}),
+                "batch_index": ("INT", {"default": -1, "min": -1, "max": 0xffff, "tooltip": "Only load this item from the batch, -1 to load all"}),
+                "channel_start": ("INT", {"default": 0, "min": 0, "max": 0xffff, "tooltip": "First channel to load"}),
+                "channel_count": ("INT", {"default": 0, "min": 0, "max": 0xffff, "tooltip": "Number of channels to load, 0 to load all"}),
             },
         }
 
     CATEGORY = "LatentTools"
-    DESCRIPTION = "Load a latent from a .pt file"
+    DESCRIPTION = "Load a latent from a .pt, .safetensors, .npy or .npz file, optionally zstd compressed, or a sharded .index.json"
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "load"
 
-    def load(self, file_path, normalize, rand_sign, rand_sign_seed):
+    def load(self, file_path, normalize, rand_sign, rand_sign_seed, load_mode="full", batch_index=-1, channel_start=0, channel_count=0):
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File {file_path} does not exist.")
 
-        samples = torch.load(file_path)
+        key = (file_fingerprint(file_path), load_mode, batch_index, channel_start, channel_count)
+        samples = _decoded_cache.get(key)
+        # The peak is the lifetime high-water mark, the difference in the current RSS shows what the read keeps resident.
+        read = "from cache"
+        if samples is None:
+            rss_before = rss_mib()
+            samples = read_latent(file_path, load_mode, batch_index, channel_start, channel_count)
+            rss_after = rss_mib()
+            read = f"RSS {rss_after - rss_before:+.1f} MiB while reading" if rss_before is not None and rss_after is not None else "read"
+
+            # Convert fp64 tensors to fp32. Numpy uses float64 by default and some people save it that way.
+            if samples.element_size() > 4: samples = samples.to(torch.float32)
 
-        # Either a plain tensor or a dict with ["samples"]: Tensor
-        if isinstance(samples, dict) and "samples" in samples:
-            samples = samples["samples"]
-        elif not isinstance(samples, torch.Tensor):
-            raise ValueError("Unexpected format in PT file.")
+            # The LATENT is supposed to be a batch of latents.
+            if len(samples.shape) == 3: samples = samples.unsqueeze(0)
 
-        # Convert fp64 tensors to fp32. Numpy uses float64 by default and some people save it that way.
-        if samples.element_size() > 4: samples = samples.to(torch.float32)
+            _decoded_cache.put(key, samples)
 
-        # The LATENT is supposed to be a batch of latents.
-        if len(samples.shape) == 3: samples.unsqueeze_(0)
+        # The cached tensor is shared, everything below must create new tensors instead of modifying it.
 
         if rand_sign:
             generator = torch.Generator().manual_seed(rand_sign_seed)
@@ -57,26 +102,28 @@ class LTLatentLoad:
             samples = samples * signs
 
         if normalize != "no":
-            # The shape of LATENT is BCHW. Normalize either just the whole latent, or each channel separately,
-            # which also normalizes the latent as a whole.
-            dims = (-2, -1) if normalize == "channel" else (-3, -2, -1)
+            # The shape of LATENT is BCHW (or BCTHW for video). Normalize either each channel separately, which also
+            # normalizes the latent as a whole, each latent, or each frame.
+            # After rand_sign we own the tensor and can normalize it in place.
+            samples = normalize_samples(samples, normalize_dims(samples, normalize), inplace=rand_sign)
 
-            means = torch.mean(samples, dim=dims, keepdim=True)
-            stds = torch.std(samples, dim=dims, keepdim=True)
-            samples = (samples - means) / stds
+        rss, peak = rss_mib(), peak_rss_mib()
+        logging.info(f"LTLatentLoad: {file_path} ({load_mode}): {list(samples.shape)} {samples.dtype}, "
+                     f"{samples.nbytes / (1024 * 1024):.1f} MiB, {read}"
+                     f"{f', RSS {rss:.1f} MiB' if rss is not None else ''}{f', peak RSS {peak:.1f} MiB' if peak is not None else ''}, "
+                     f"cache: {_decoded_cache.stats()}")
 
         return ({"samples": samples},)
 
     @classmethod
-    def IS_CHANGED(cls, file_path, normalize, rand_sign, rand_sign_seed):
-        m = hashlib.sha256()
-        with open(file_path, 'rb') as f:
-            m.update(f.read())
-        return (m.digest().hex(), normalize, rand_sign, rand_sign_seed)
+    def IS_CHANGED(cls, file_path, normalize, rand_sign, rand_sign_seed, load_mode="full", batch_index=-1, channel_start=0, channel_count=0):
+        # Only re-hashes the file when its size, mtime or inode change.
+        return (file_fingerprint(file_path), normalize, rand_sign, rand_sign_seed, load_mode, batch_index, channel_start, channel_count)
 
     @classmethod
-    def VALIDATE_INPUTS(cls, file_path, normalize, rand_sign, rand_sign_seed):
+    def VALIDATE_INPUTS(cls, file_path, normalize, rand_sign, rand_sign_seed, load_mode="full", batch_index=-1, channel_start=0, channel_count=0):
         if normalize not in normalize_options: return f"Invalid option: {normalize}. Expected one of {normalize_options}"
+        if load_mode not in load_modes: return f"Invalid option: {load_mode}. Expected one of {load_modes}"
 
         if not os.path.exists(file_path):
             return f"Invalid latent file: {file_path}"
@@ -0,0 +1,334 @@
+import math
+import time
+import torch
+import logging
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+rng_options = ["cpu", "philox"]
+seed_modes = ["batch", "per_item"]
+dtype_options = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+device_options = ["cpu", "gpu"]
+prefetch_options = ["device", "stream"]
+
+# Elements generated at once per thread. Bounds the size of the temporaries.
+chunk_size = 1 << 18
+
+# Philox4x32-10 (Salmon et al., "Parallel Random Numbers: As Easy as 1, 2, 3")
+_M0, _M1 = 0xD2511F53, 0xCD9E8D57
+_W0, _W1 = 0x9E3779B9, 0xBB67AE85
+_MASK = 0xFFFFFFFF
+
+
+def get_device(device: str) -> torch.device:
+    if device == "gpu":
+        import comfy.model_management
+        return comfy.model_management.get_torch_device()
+    return torch.device("cpu")
+
+
+def _mulhilo(m: int, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    # 32x32 -> 64 bit product in int64 without overflowing: multiply by 16 bit halves of x.
+    lo_part = m * (x & 0xFFFF)
+    hi_part = m * (x >> 16)
+    low = lo_part + ((hi_part & 0xFFFF) << 16)
+    return ((hi_part >> 16) + (low >> 32)) & _MASK, low & _MASK
+
+
+def philox(counters: torch.Tensor, seed: int) -> torch.Tensor:
+    """Philox4x32-10 of N x 4 int64 counters holding 32 bit values. Returns N x 4 random 32 bit values in int64"""
+    c0, c1, c2, c3 = counters.unbind(-1)
+    k0, k1 = seed & _MASK, (seed >> 32) & _MASK
+    for _ in range(10):
+        hi0, lo0 = _mulhilo(_M0, c0)
+        hi1, lo1 = _mulhilo(_M1, c2)
+        c0, c1, c2, c3 = hi1 ^ c1 ^ k0, lo1, hi0 ^ c3 ^ k1, lo0
+        k0, k1 = (k0 + _W0) & _MASK, (k1 + _W1) & _MASK
+    return torch.stack((c0, c1, c2, c3), dim=-1)
+
+
+def _philox_blocks(first: int, last: int, seed: int, device: torch.device, stream: int = 0) -> torch.Tensor:
+    # Blocks [first, last] of the sequence. Different streams are independent sequences for the same seed.
+    blocks = torch.arange(first, last + 1, dtype=torch.int64, device=device)
+    counters = torch.stack((blocks & _MASK, blocks >> 32, torch.full_like(blocks, stream & _MASK), torch.zeros_like(blocks)), dim=-1)
+    return philox(counters, seed)
+
+
+def philox_bits(start: int, count: int, seed: int, device: torch.device, stream: int = 0) -> torch.Tensor:
+    """Elements [start, start + count) of the raw 32 bit random sequence for seed and stream, in int64"""
+    first = start // 4
+    bits = _philox_blocks(first, (start + count - 1) // 4, seed, device, stream)
+    offset = start - first * 4
+    return bits.view(-1)[offset:offset + count]
+
+
+def philox_random(start: int, count: int, seed: int, distribution: str, device: torch.device) -> torch.Tensor:
+    """Elements [start, start + count) of the float32 random sequence for seed.
+
+    Every 4 consecutive elements come from one Philox block, so any range can be generated independently
+    of the others, and the result does not depend on how the sequence is split up.
+    """
+    first = start // 4
+    bits = _philox_blocks(first, (start + count - 1) // 4, seed, device)
+
+    # 24 bit uniforms, exactly representable in float32.
+    if distribution == "uniform":
+        values = (bits >> 8).to(torch.float32).mul_(2 ** -24)
+    elif distribution == "gaussian":
+        # Box-Muller, each pair of 32 bit values gives a pair of normals.
+        u1 = ((bits[:, 0::2] >> 8) + 1).to(torch.float32).mul_(2 ** -24)  # (0, 1]
+        u2 = (bits[:, 1::2] >> 8).to(torch.float32).mul_(2 ** -24 * 2 * math.pi)
+        r = u1.log_().mul_(-2).sqrt_()
+        values = torch.stack((r * torch.cos(u2), r * torch.sin(u2)), dim=-1).view(-1, 4)
+    else:
+        raise ValueError(f"Unknown distribution: {distribution}")
+
+    offset = start - first * 4
+    return values.view(-1)[offset:offset + count]
+
+
+def philox_fill_(out: torch.Tensor, seed: int, distribution: str, scale: float = 1., shift: float = 0., start: int = 0) -> torch.Tensor:
+    """Fill out with values [start, start + out.numel()) of the random sequence, * scale + shift.
+
+    The work is split into chunks that are generated in parallel threads, and written directly into out.
+    """
+    assert out.is_contiguous(), "out must be contiguous"
+    flat = out.view(-1)
+    n = flat.numel()
+
+    def fill(s: int):
+        e = min(s + chunk_size, n)
+        flat[s:e].copy_(philox_random(start + s, e - s, seed, distribution, out.device).mul_(scale).add_(shift))
+
+    chunks = range(0, n, chunk_size)
+    if out.device.type == "cpu" and len(chunks) > 1:
+        # torch releases the GIL, and the chunks are too small for the intra-op thread pool to matter.
+        with ThreadPoolExecutor(max_workers=torch.get_num_threads()) as pool:
+            list(pool.map(fill, chunks))
+    else:
+        for s in chunks: fill(s)
+    return out
+
+
+def _item_seed(seed: int, index: int) -> int:
+    return (seed + index) & 0xFFFFFFFFFFFFFFFF
+
+
+def _item_count(batch_size: int, start: int, count: int) -> int:
+    if count == 0: count = batch_size - start
+    if start < 0 or count < 1 or start + count > batch_size:
+        raise ValueError(f"Items [{start}, {start + count}) are out of range for batch size {batch_size}")
+    return count
+
+
+def generate_noise(shape: tuple[int, ...], distribution: str, seed: int, scale: float, shift: float, rng: str = "cpu",
+                   dtype: torch.dtype = torch.float32, device: torch.device = torch.device("cpu"),
+                   seed_mode: str = "batch", start: int = 0, count: int = 0) -> torch.Tensor:
+    """Items [start, start + count) (count 0 for all) of a batch of gaussian (scale=std, shift=mean) or uniform
+    (scale=max-min, shift=min) noise.
+
+    seed_mode=batch: the whole batch is one random sequence.
+    seed_mode=per_item: item k is generated on its own with seed + k.
+    The items are the same as in the full batch. Only the cpu rng in batch mode has to generate the items before start.
+    """
+    if distribution not in ("gaussian", "uniform"): raise ValueError(f"Unknown distribution: {distribution}")
+    if rng not in rng_options: raise ValueError(f"Unknown rng: {rng}. Expected one of {rng_options}")
+    if seed_mode not in seed_modes: raise ValueError(f"Unknown seed mode: {seed_mode}. Expected one of {seed_modes}")
+
+    batch_size, item_shape = shape[0], tuple(shape[1:])
+    count = _item_count(batch_size, start, count)
+
+    if rng == "philox":
+        out = torch.empty((count, *item_shape), dtype=dtype, device=device)
+        if seed_mode == "batch":
+            # Skip straight to the first element of the first item.
+            return philox_fill_(out, seed, distribution, scale, shift, start=start * out[0].numel())
+        for i in range(count):
+            philox_fill_(out[i], _item_seed(seed, start + i), distribution, scale, shift)
+        return out
+
+    # The legacy sequential CPU generator. Keep producing the same noise for the same seed.
+    def sequential(seed: int, shape: tuple[int, ...]) -> torch.Tensor:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        return torch.randn(shape, generator=generator) if distribution == "gaussian" else torch.rand(shape, generator=generator)
+
+    if seed_mode == "batch":
+        # The sequence can't be skipped, generate everything up to the last item we need.
+        samples = sequential(seed, (start + count, *item_shape))
+        if start > 0: samples = samples[start:].clone()
+    else:
+        samples = torch.stack([sequential(_item_seed(seed, start + i), item_shape) for i in range(count)])
+
+    samples.mul_(scale).add_(shift)
+    return samples.to(dtype=dtype, device=device)
+
+
+@dataclass(frozen=True)
+class NoiseDescriptor:
+    """Noise that is only generated when and where it's needed. Stored in LATENT["noise"] instead of LATENT["samples"].
+
+    Describes the items [start, start + shape[0]) of a batch of generate_noise() noise.
+    """
+    distribution: str
+    scale: float
+    shift: float
+    seed: int
+    shape: tuple[int, ...]
+    batch_size: int
+    start: int = 0
+    rng: str = "cpu"
+    seed_mode: str = "batch"
+    dtype: torch.dtype = torch.float32
+    device: torch.device = torch.device("cpu")
+
+    def _generate(self, start: int, count: int, device: torch.device) -> torch.Tensor:
+        return generate_noise((self.batch_size, *self.shape[1:]), self.distribution, self.seed, self.scale, self.shift, self.rng,
+                              self.dtype, device, self.seed_mode, start=self.start + start, count=count)
+
+    def materialize(self, indices: list[int] | None = None, device: torch.device | None = None) -> torch.Tensor:
+        """Generate the noise, or just the batch items at indices"""
+        device = self.device if device is None else device
+        if indices is None:
+            return self._generate(0, self.shape[0], device)
+        if self.shape[0] == 1:
+            # Like lt_prepare_noise, the same noise for every item.
+            return self.materialize(device=device).expand(len(indices), *self.shape[1:])
+
+        unique = sorted(set(indices))
+        if unique[0] < 0 or unique[-1] >= self.shape[0]:
+            raise ValueError(f"Noise indices {unique[0]}..{unique[-1]} are out of range for batch size {self.shape[0]}")
+
+        if self.rng == "cpu" and self.seed_mode == "batch":
+            # The sequence can't be skipped anyway, generate the whole range.
+            items = self._generate(unique[0], unique[-1] - unique[0] + 1, device)
+            unique = list(range(unique[0], unique[-1] + 1))
+        else:
+            items = torch.cat([self._generate(i, 1, device) for i in unique])
+
+        if unique == list(indices): return items
+        position = {index: p for p, index in enumerate(unique)}
+        return items[torch.tensor([position[i] for i in indices], device=items.device)]
+
+
+def noise_latent(shape: tuple[int, ...], distribution: str, seed: int, scale: float, shift: float, rng: str, dtype: torch.dtype,
+                 device: torch.device, seed_mode: str, start: int, count: int, lazy: bool) -> dict:
+    """A LATENT with the noise, or with a NoiseDescriptor that generates it later"""
+    if not lazy:
+        return {"samples": generate_noise(shape, distribution, seed, scale, shift, rng, dtype, device, seed_mode, start, count)}
+
+    if distribution not in ("gaussian", "uniform"): raise ValueError(f"Unknown distribution: {distribution}")
+    if rng not in rng_options: raise ValueError(f"Unknown rng: {rng}. Expected one of {rng_options}")
+    if seed_mode not in seed_modes: raise ValueError(f"Unknown seed mode: {seed_mode}. Expected one of {seed_modes}")
+    count = _item_count(shape[0], start, count)
+    return {"noise": NoiseDescriptor(distribution, scale, shift, seed, (count, *shape[1:]), shape[0], start, rng, seed_mode, dtype, device)}
+
+
+def latent_shape(latent: dict) -> torch.Size:
+    if "noise" in latent: return torch.Size(latent["noise"].shape)
+    return latent["samples"].shape
+
+
+def latent_samples(latent: dict, device: torch.device | None = None) -> torch.Tensor:
+    """latent["samples"], or the generated noise if the latent is a NoiseDescriptor.
+
+    The device only applies to noise descriptors, they are generated directly there.
+    """
+    assert isinstance(latent, dict), f"Incorrect type for latent: Expected dict, got {type(latent)}"
+    if "noise" in latent:
+        return latent["noise"].materialize(device=device)
+    return latent["samples"]
+
+
+def lt_prepare_noise(latent_noise: torch.Tensor, noise_inds: list[int] | None = None) -> torch.Tensor:
+    """The noise for the batch items at noise_inds (a LATENT batch_index), gathered in one go.
+
+    Returns latent_noise itself when the indices are the identity, and a view when there is a single noise item.
+    """
+    if noise_inds is None:
+        return latent_noise
+
+    inds = torch.as_tensor(noise_inds, dtype=torch.int64).flatten()
+    size = latent_noise.shape[0]
+    if size == 1:
+        # The same noise for every item, no need to copy it.
+        return latent_noise.expand(inds.numel(), *latent_noise.shape[1:])
+
+    if inds.numel() > 0 and (inds.min() < 0 or inds.max() >= size):
+        raise ValueError(f"batch_index {inds.min().item()}..{inds.max().item()} is out of range for noise batch size {size}")
+    if inds.numel() == size and torch.equal(inds, torch.arange(size)):
+        return latent_noise
+    return latent_noise.index_select(0, inds.to(latent_noise.device))
+
+
+class NoiseTimeline:
+    """A noise_sampler for the k-diffusion ancestral samplers that returns noise[:, step] at each step (wrapping around).
+
+    noise is B,T,... (B,... is a single step). Create one per sampling run, it keeps track of the step.
+    With prefetch="device" the whole timeline is copied to the device once.
+    With "stream" (CUDA only), each step is copied from a pinned double buffer on a side stream while the previous
+    step is running, which keeps the device memory at one step.
+    """
+    def __init__(self, noise: torch.Tensor, device: torch.device, prefetch: str = "device"):
+        if prefetch not in prefetch_options: raise ValueError(f"Unknown prefetch: {prefetch}. Expected one of {prefetch_options}")
+        if noise.dim() == 4: noise = noise.unsqueeze(1)
+        self.device = torch.device(device)
+        self.steps = noise.shape[1]
+        self.step = 0
+        # Host to device copy time, as (start, end) CUDA events, or ms when measured on the host.
+        self._transfers: list = []
+
+        self.stream = torch.cuda.Stream(self.device) if prefetch == "stream" and self.device.type == "cuda" else None
+        if self.stream is None:
+            start = time.perf_counter()
+            self.noise = noise.to(self.device)
+            if self.device.type == "cuda": torch.cuda.synchronize(self.device)
+            self._transfers.append((time.perf_counter() - start) * 1000)
+            return
+
+        self.noise = noise
+        self.host = [torch.empty(noise[:, 0].shape, dtype=noise.dtype, pin_memory=True) for _ in range(2)]
+        self.copied: list[torch.cuda.Event | None] = [None, None]
+        self.pending = self._prefetch(0)
+
+    def _prefetch(self, step: int) -> torch.Tensor:
+        k = step % 2
+        # The previous copy from this buffer must be done before it's overwritten.
+        if self.copied[k] is not None: self.copied[k].synchronize()
+        self.host[k].copy_(self.noise[:, step % self.steps])
+        with torch.cuda.stream(self.stream):
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            out = self.host[k].to(self.device, non_blocking=True)
+            end.record()
+        self.copied[k] = end
+        self._transfers.append((start, end))
+        return out
+
+    def __call__(self, sigma, sigma_next) -> torch.Tensor:
+        step = self.step
+        self.step += 1
+        if self.stream is None:
+            out = self.noise[:, step % self.steps]
+        else:
+            out = self.pending
+            main = torch.cuda.current_stream(self.device)
+            main.wait_stream(self.stream)
+            out.record_stream(main)
+            self.pending = self._prefetch(self.step)
+
+        # Measuring the copies synchronizes, only do it when someone is listening.
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"NoiseTimeline: step {step} sigma {float(sigma):.4f} -> {float(sigma_next):.4f}, transfers so far {self.transfer_ms():.3f} ms")
+        return out
+
+    def transfer_ms(self) -> float:
+        """Total time spent copying noise to the device. Waits for the pending copies"""
+        total = 0.
+        for t in self._transfers:
+            if isinstance(t, float):
+                total += t
+            else:
+                t[1].synchronize()
+                total += t[0].elapsed_time(t[1])
+        return total
@@ -0,0 +1,26 @@
+import torch
+
+normalize_options = ["no", "channel", "image", "frame"]
+
+
+def normalize_dims(samples: torch.Tensor, mode: str) -> tuple[int, ...]:
+    """The dimensions to compute the statistics over, for each channel, image or frame. Use "all" for the whole tensor"""
+    # The latent is B,C,... with any number of spatial (or time) dims, like B,C,H,W or B,C,T,H,W for video.
+    if mode == "channel": return tuple(range(2, samples.dim()))
+    if mode == "image": return tuple(range(1, samples.dim()))
+    if mode == "frame":
+        # Normalize each video frame across all channels. An image is a single frame.
+        return (1, 3, 4) if samples.dim() == 5 else tuple(range(1, samples.dim()))
+    if mode == "all": return tuple(range(samples.dim()))
+    raise ValueError(f"Unknown normalization mode: {mode}")
+
+
+def normalize(samples: torch.Tensor, dims: tuple[int, ...], inplace: bool = False) -> torch.Tensor:
+    """(samples - mean) / std over dims.
+
+    The statistics are computed in a single pass, and at most one full-size tensor is allocated.
+    With inplace=True, nothing is allocated, but samples is modified - only use it on tensors nobody else holds.
+    """
+    stds, means = torch.std_mean(samples, dim=dims, keepdim=True)
+    out = samples.sub_(means) if inplace else samples - means
+    return out.div_(stds)
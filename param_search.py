@@ -1,5 +1,6 @@
 import random
 import sys
+import torch
 
 def create_float_step_class(step_value):
     """Dynamically create a float step class with the given step value"""
@@ -88,3 +89,110 @@ class LTNumberRangeGaussian:
         local_random = random.Random(seed)
         result = local_random.gauss(mean, std)
         return result, int(result), str(round(result, 5))
+
+
+# Item i of the lists is the value the single-value nodes give for seed + i,
+# so a list is the same as a run of queue entries with an incrementing seed.
+
+class LTNumberListUniform:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "min_value": ("FLOAT", {"default": 0.0, "min": -1000000, "max": 1000000, "step":0.00001}),
+                "max_value": ("FLOAT", {"default": 1.0, "min": -1000000, "max": 1000000, "step":0.00001}),
+                "count": ("INT", {"default": 8, "min": 1, "max": 10000}),
+                "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff,
+                                 "control_after_generate": True, "tooltip": "Item i is the same as LTNumberRangeUniform with seed + i"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "A list of count parameter values from a uniform distribution"
+    FUNCTION = "param_list_uniform"
+    RETURN_TYPES = ("FLOAT", "INT", "STRING")
+    OUTPUT_IS_LIST = (True, True, True)
+
+    def param_list_uniform(self, min_value: float, max_value: float, count: int, seed: int):
+        values = [random.Random(seed + i).uniform(min_value, max_value) for i in range(count)]
+        return values, [int(v) for v in values], [str(round(v, 5)) for v in values]
+
+
+class LTNumberListGaussian:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "mean": ("FLOAT", {"default": 0.0, "min": -1000000, "max": 1000000, "step":0.00001}),
+                "std": ("FLOAT", {"default": 1.0, "min": 0.00001, "max": 1000000, "step":0.00001}),
+                "count": ("INT", {"default": 8, "min": 1, "max": 10000}),
+                "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff,
+                                 "control_after_generate": True, "tooltip": "Item i is the same as LTNumberRangeGaussian with seed + i"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "A list of count parameter values from a gaussian distribution"
+    FUNCTION = "param_list_gaussian"
+    RETURN_TYPES = ("FLOAT", "INT", "STRING")
+    OUTPUT_IS_LIST = (True, True, True)
+
+    def param_list_gaussian(self, mean: float, std: float, count: int, seed: int):
+        values = [random.Random(seed + i).gauss(mean, std) for i in range(count)]
+        return values, [int(v) for v in values], [str(round(v, 5)) for v in values]
+
+
+designs = ["random", "lhs", "sobol", "grid"]
+design_params = "abcd"
+
+def design_points(design: str, count: int, dims: int, seed: int) -> list[list[float]]:
+    """count points in [0, 1]^dims. grid has round(count ** (1 / dims)) levels per dimension instead"""
+    if design == "random":
+        # Per point, like the list nodes.
+        return [[r.random() for _ in range(dims)] for r in (random.Random(seed + i) for i in range(count))]
+    if design == "lhs":
+        # Latin hypercube: one point in each of the count strata of every dimension.
+        generator = torch.Generator().manual_seed(seed)
+        strata = torch.stack([torch.randperm(count, generator=generator) for _ in range(dims)], dim=1)
+        return ((strata + torch.rand(count, dims, generator=generator, dtype=torch.float64)) / count).tolist()
+    if design == "sobol":
+        # Scrambled Sobol points. The first n points are the same for any count.
+        return torch.quasirandom.SobolEngine(dims, scramble=True, seed=seed).draw(count, dtype=torch.float64).tolist()
+    if design == "grid":
+        levels = max(1, round(count ** (1 / dims)))
+        axis = torch.linspace(0, 1, levels, dtype=torch.float64) if levels > 1 else torch.tensor([0.5], dtype=torch.float64)
+        return torch.cartesian_prod(*[axis] * dims).reshape(-1, dims).tolist()
+    raise ValueError(f"Unknown design: {design}. Expected one of {designs}")
+
+
+class LTParamDesign:
+    @classmethod
+    def INPUT_TYPES(cls):
+        params = {}
+        for p in design_params:
+            params[f"{p}_min"] = ("FLOAT", {"default": 0.0, "min": -1000000, "max": 1000000, "step":0.00001})
+            params[f"{p}_max"] = ("FLOAT", {"default": 1.0, "min": -1000000, "max": 1000000, "step":0.00001})
+        return {
+            "required": {
+                "design": (designs, {"default": "lhs", "tooltip": "random: independent points. lhs: Latin hypercube, evenly covers each parameter. sobol: low-discrepancy sequence. grid: every combination of evenly spaced levels"}),
+                "dims": ("INT", {"default": 2, "min": 1, "max": len(design_params), "tooltip": "How many of the parameters to vary. The rest stay at their min"}),
+                "count": ("INT", {"default": 16, "min": 1, "max": 10000, "tooltip": "The number of points. For grid, the number of levels per parameter is round(count ** (1 / dims))"}),
+                "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "control_after_generate": True}),
+            } | params
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Lists of values for up to 4 parameters, covering their ranges together"
+    FUNCTION = "param_design"
+    RETURN_TYPES = ("FLOAT", ) * len(design_params) + ("STRING", )
+    RETURN_NAMES = tuple(design_params) + ("label", )
+    OUTPUT_IS_LIST = (True, ) * (len(design_params) + 1)
+
+    def param_design(self, design: str, dims: int, count: int, seed: int, **ranges):
+        points = design_points(design, count, dims, seed)
+        columns = []
+        for d, p in enumerate(design_params):
+            lo, hi = ranges[f"{p}_min"], ranges[f"{p}_max"]
+            columns.append([lo + (hi - lo) * point[d] if d < dims else lo for point in points])
+        labels = [" ".join(f"{p}={round(columns[d][i], 5)}" for d, p in enumerate(design_params[:dims])) for i in range(len(points))]
+        return *columns, labels
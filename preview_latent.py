@@ -1,17 +1,140 @@
-from operator import getitem
+import os
 import torch
-from io import BytesIO
-import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 import lovely_tensors as lt
+from typing import Callable
 import folder_paths  # For ComfyUI file handling
 
+from .noise import latent_samples
+from .file_cache import tensor_fingerprint
+from .preview_render import renderers, plot_png, chans_png, subsample, downsample_images
+
+
+def _temp_path(fingerprint: str, kind: str) -> tuple[dict, str]:
+    """The /view reference and the path of a preview image in the temp directory"""
+    filename = f"lt_preview_{fingerprint}_{kind}.png"
+    return {"filename": filename, "subfolder": "", "type": "temp"}, os.path.join(folder_paths.get_temp_directory(), filename)
+
+
+def _write_png(path: str, render: Callable[[], bytes]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Never let the browser see a partially written file.
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f: f.write(render())
+    os.replace(tmp, path)
+
+
+def _summary(name: str, x: torch.Tensor, stats: torch.Tensor, images_numel: int, factor: int) -> str:
+    if stats.numel() == x.numel() and images_numel == x.numel():
+        return f"""
+    <div class="flex gap-2 items-center">{name}:
+        <pre>{lt.lovely(x, depth=2, color=False)}</pre>
+    </div>
+    <div class="flex gap-2">Image: Batch size:  {x.shape[0]}  Resolution:  {x.shape[-1]*8} x {x.shape[-2]*8}</div>
+    """
+
+    return f"""
+    <div class="flex gap-2"><b>Approximate preview:</b> statistics from {stats.numel():,} of {x.numel():,} elements,
+        channel images {"downsampled " + str(factor) + "x, " if factor > 1 else ""}{images_numel:,} of {x.numel():,} pixels</div>
+    <div class="flex gap-2 items-center">{name}: shape={list(x.shape)} dtype={x.dtype}, sampled:
+        <pre>{lt.lovely(stats, depth=2, color=False)}</pre>
+    </div>
+    <div class="flex gap-2">Image: Batch size:  {x.shape[0]}  Resolution:  {x.shape[-1]*8} x {x.shape[-2]*8}</div>
+    """
+
+
+# (path, plot_png or chans_png, tensor) of an image that still has to be rendered
+RenderJob = tuple[str, Callable[[torch.Tensor, str], bytes], torch.Tensor]
+
+
+def prepare_preview(tensors: list[tuple[str, torch.Tensor]], renderer: str, max_elements: int) -> tuple[dict, list[RenderJob]]:
+    """The UI message for the preview of the (name, tensor) pairs, and the images it refers to that are not rendered yet"""
+    summaries, plots, chans, jobs = [], [], [], []
+    for name, x in tensors:
+        # Keep huge latents within the budget.
+        stats = subsample(x, max_elements)
+        images, factor = downsample_images(x, max_elements)
+        summaries.append(_summary(name, x, stats, images.numel(), factor))
+
+        # An image only needs to be rendered once for the same input and renderer. The inputs are within the budget,
+        # so this hashes at most max_elements values, not the whole latent.
+        for kind, title, render, t, refs in (("plot", f"{name} distribution", plot_png, stats, plots), ("chans", f"{name} channels", chans_png, images, chans)):
+            ref, path = _temp_path(tensor_fingerprint(t, renderer), kind)
+            if not os.path.exists(path): jobs.append((path, render, t))
+            refs.append(ref | {"title": title})
+
+    summary = f"""
+<div class="flex flex-col gap-0.5">
+{"".join(summaries)}
+</div>
+"""
+    return {"html": (summary, ), "lt_images": plots + chans}, jobs
+
+
+def render_jobs(jobs: list[RenderJob], renderer: str):
+    if renderer == "matplotlib":
+        # lt uses matplotlib. Set non-interactive backend here.
+        import matplotlib
+        matplotlib.use('Agg')  # Set non-interactive backend
+    for path, render, x in jobs:
+        _write_png(path, lambda: render(x, renderer))
+
+
+# A single worker: pyplot is not thread safe, and the previews should not compete with each other anyway.
+_render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LTPreviewLatent")
+_render_lock = threading.Lock()
+# node id -> (generation, future) of the latest render
+_renders: dict[str, tuple[int, Future]] = {}
+_generation = 0
+
+
+def _is_latest(node_id: str, generation: int) -> bool:
+    with _render_lock:
+        return _renders[node_id][0] == generation
+
+
+def _render_and_send(node_id: str, generation: int, jobs: list[RenderJob], renderer: str, ui: dict, sid: str | None):
+    # A newer execution of this node arrived while we were waiting.
+    if not _is_latest(node_id, generation): return
+    try:
+        render_jobs(jobs, renderer)
+    except Exception as e:
+        logging.exception("LTPreviewLatent: Rendering failed")
+        ui = {"html": (f"<div>Preview failed: {e}</div>", ), "lt_images": []}
+    if not _is_latest(node_id, generation): return
+
+    from server import PromptServer
+    PromptServer.instance.send_sync("latent_tools.preview", {"node": node_id, **ui}, sid)
+
+
+def render_async(node_id: str, jobs: list[RenderJob], renderer: str, ui: dict):
+    """Render the images in the background, then tell the client that queued the prompt. Cancels the pending render for the same node"""
+    global _generation
+    from server import PromptServer
+    sid = PromptServer.instance.client_id
+    # The caller may modify or free its tensors (or they may be on the GPU), render from private CPU copies.
+    jobs = [(path, render, x.detach().to("cpu", copy=True)) for path, render, x in jobs]
+    with _render_lock:
+        _generation += 1
+        previous = _renders.get(node_id)
+        if previous is not None: previous[1].cancel()
+        future = _render_pool.submit(_render_and_send, node_id, _generation, jobs, renderer, ui, sid)
+        _renders[node_id] = (_generation, future)
+
+
 class LTPreviewLatent:
     @classmethod
     def INPUT_TYPES(cls):
         return {
             "required": {
                 "latent": ("LATENT", {}),
-            }
+                "renderer": (renderers, {"default": renderers[0], "tooltip": "matplotlib: lovely-tensors plots. fast: histogram and channel images drawn directly, much faster for large latents"}),
+                "max_elements": ("INT", {"default": 1 << 20, "min": 0, "max": 0xffffffff, "tooltip": "Above this size, the statistics come from a random sample and the channel images are downsampled. 0 for no limit"}),
+                "background": ("BOOLEAN", {"default": True, "tooltip": "Render in a background thread without blocking the queue. The preview shows up when it's ready"}),
+            },
+            "hidden": {"unique_id": "UNIQUE_ID"},
         }
 
     CATEGORY = "LatentTools"
@@ -20,94 +143,23 @@ class LTPreviewLatent:
     OUTPUT_NODE = True
     RETURN_TYPES = ()
 
-    def preview(self, latent: dict):
+    def preview(self, latent: dict, renderer: str = "matplotlib", max_elements: int = 1 << 20, background: bool = True, unique_id: str | None = None):
 
         assert isinstance(latent, dict), f"Incorrect type for latent: Expected dict, got {type(latent)}"
-        samples = latent["samples"]
+        samples = latent_samples(latent)
         assert isinstance(samples, torch.Tensor), f"Incorrect type for latent.samplels: Expected torch.Tensor, got {type(samples)}"
 
         mask = latent.get("noise_mask", None)
 
-        # lt uses matplotlib. Set non-interactive backend here.
-        import matplotlib
-        matplotlib.use('Agg')  # Set non-interactive backend
-        # Generate PNG plot
-        buf = BytesIO()
-        lt.plot(samples, center="range").fig.savefig(buf, format='png', dpi=100, bbox_inches='tight', pad_inches=0.1)
-        plot_data_url = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
-
-        # Generate image for channels visualization
-        buf = BytesIO()
-        lt.chans(samples, scale=2).fig.savefig(buf, format='png', dpi=100, bbox_inches='tight', pad_inches=0)
-        img_data_url = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
-
-        latent_summary = f"""
-    <div class="flex gap-2 items-center">Latent:
-        <pre>{lt.lovely(samples, depth=2, color=False)}</pre>
-    </div>
-    <div class="flex gap-2">Image: Batch size:  {samples.shape[0]}  Resolution:  {samples.shape[-1]*8} x {samples.shape[-2]*8}</div>
-    """
+        tensors = [("Latent", samples)] + ([("Mask", mask)] if mask is not None else [])
 
-        latent_plt = f"""
-    <div class="flex flex-col gap-1">
-        Distribution:
-        <img src="{plot_data_url}">
-    </div>
-    """
+        ui, jobs = prepare_preview(tensors, renderer, max_elements)
+        if not jobs: return {"ui": ui}
 
-        latent_chans = f"""
-    <div class="flex flex-col gap-1">
-        Channels:
-        <img src="{img_data_url}">
-    </div>
-    """
+        if background and unique_id is not None:
+            # The UI already refers to the final images. That's what history and cached executions will show.
+            render_async(str(unique_id), jobs, renderer, ui)
+            return {"ui": ui | {"lt_pending": (True, )}}
 
-        if mask is not None:
-            # Generate PNG plot
-            buf = BytesIO()
-            lt.plot(mask, center="range").fig.savefig(buf, format='png', dpi=100, bbox_inches='tight', pad_inches=0.1)
-            mask_plot_data_url = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
-
-            # Generate image for channels visualization
-            buf = BytesIO()
-            lt.chans(mask, scale=2).fig.savefig(buf, format='png', dpi=100, bbox_inches='tight', pad_inches=0)
-            mask_img_data_url = f"data:image/png;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
-
-            mask_summary = f"""
-        <div class="flex gap-2 items-center">Latent:
-            <pre>{lt.lovely(mask, depth=2, color=False)}</pre>
-        </div>
-        <div class="flex gap-2">Image: Batch size:  {mask.shape[0]}  Resolution:  {mask.shape[-1]*8} x {mask.shape[-2]*8}</div>
-        """
-
-            mask_plt = f"""
-        <div class="flex flex-col gap-1">
-            Distribution:
-            <div class="comfy-img-preview">
-                <img src="{mask_plot_data_url}">
-            </div>
-        </div>
-        """
-
-            mask_chans = f"""
-        <div class="flex flex-col gap-1"
-            Channels:
-            <div class="comfy-img-preview">
-                <img src="{mask_img_data_url}" >
-            </div>
-        </div>
-        """
-        else:
-            mask_summary = mask_plt = mask_chans = ""
-
-        html = f"""
-<div class="flex flex-col gap-0.5">
-{latent_summary}
-{mask_summary}
-{latent_plt}
-{mask_plt}
-{latent_chans}
-{mask_chans}
-</div>
-"""
-        return {"ui": {"html": (html, )}}
\ No newline at end of file
+        render_jobs(jobs, renderer)
+        return {"ui": ui}
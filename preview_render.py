@@ -0,0 +1,146 @@
+import math
+import torch
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageDraw
+import lovely_tensors as lt
+
+renderers = ["matplotlib", "fast"]
+
+# Diverging colormap for the fast renderer: -1 is blue, 0 is light grey, 1 is red (the ends of matplotlib "coolwarm").
+# Out of range values get the same colors as in lovely-tensors.
+_cmap_anchors = np.array([[59, 76, 192], [221, 221, 221], [180, 4, 38]], dtype=np.float32)
+_lut = torch.from_numpy(np.stack([np.interp(np.linspace(-1, 1, 256), [-1, 0, 1], _cmap_anchors[:, c]) for c in range(3)], axis=-1).astype(np.uint8))
+_below, _above, _nan, _ninf, _pinf = (0, 0, 255), (255, 0, 0), (255, 255, 0), (0, 255, 255), (255, 0, 255)
+
+_gutter_px, _frame_px = 3, 1
+
+
+def _png(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    # Speed over size, the images are small anyway.
+    img.save(buf, format="png", compress_level=1)
+    return buf.getvalue()
+
+
+def _fig_png(fig, pad_inches: float) -> bytes:
+    import matplotlib.pyplot as plt
+    buf = BytesIO()
+    fig.savefig(buf, format="png", dpi=100, bbox_inches="tight", pad_inches=pad_inches)
+    # Figures are not garbage collected while pyplot holds on to them.
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def colorize(x: torch.Tensor) -> torch.Tensor:
+    """Map values to RGB uint8, adding a channel-last dimension"""
+    x = x.float()
+    idx = ((x.clamp(-1, 1) + 1) * 127.5).round_().nan_to_num_(0).to(torch.int64)
+    rgb = _lut[idx]
+    for mask, color in ((x < -1, _below), (x > 1, _above), (x == -math.inf, _ninf), (x == math.inf, _pinf), (x.isnan(), _nan)):
+        rgb[mask] = torch.tensor(color, dtype=torch.uint8)
+    return rgb
+
+
+def chans_image(x: torch.Tensor, scale: int = 2, view_width: int = 966) -> Image.Image:
+    """Tile the ...,H,W images of x in a grid: one row per index of the leading dimensions, one column per index of the last one"""
+    if x.dim() == 2: x = x[None]
+    h, w = x.shape[-2:]
+    cols = x.shape[-3]
+    images = x.reshape(-1, h, w)
+
+    # Reduce the scale if the grid would be too wide.
+    scale = max(1, min(scale, view_width // (cols * (w + 2 * _frame_px + _gutter_px))))
+
+    rgb = colorize(images)  # N, H, W, 3
+    if scale > 1: rgb = rgb.repeat_interleave(scale, dim=1).repeat_interleave(scale, dim=2)
+    # Black frame, then a white gutter on the right and bottom of each image.
+    rgb = torch.nn.functional.pad(rgb.permute(0, 3, 1, 2), (_frame_px,) * 4, value=0)
+    rgb = torch.nn.functional.pad(rgb, (0, _gutter_px, 0, _gutter_px), value=255)
+
+    rows = images.shape[0] // cols
+    _, _, th, tw = rgb.shape
+    grid = rgb.view(rows, cols, 3, th, tw).permute(0, 3, 1, 4, 2).reshape(rows * th, cols * tw, 3)
+    return Image.fromarray(grid[:-_gutter_px, :-_gutter_px].contiguous().numpy())
+
+
+def histogram_image(x: torch.Tensor, bins: int = 200, width: int = 600, height: int = 160) -> Image.Image:
+    """Histogram of the finite values, with the mean and ±σ marked, like lovely-tensors plot"""
+    x = x.float().flatten()
+    x = x[x.isfinite()]
+    img = Image.new("RGB", (width, height + 20), "white")
+    draw = ImageDraw.Draw(img)
+    if x.numel() == 0:
+        draw.text((4, 4), "No finite values", fill="black")
+        return img
+
+    lo, hi = x.min().item(), x.max().item()
+    # Center the range around 0 like center="range" does.
+    if lo < 0 < hi: lo, hi = -max(-lo, hi), max(-lo, hi)
+    if lo == hi: lo, hi = lo - 1, hi + 1
+    std, mean = torch.std_mean(x) if x.numel() > 1 else (torch.tensor(0.), x[0])
+    std, mean = std.item(), mean.item()
+
+    counts = torch.histc(x, bins=bins, min=lo, max=hi)
+    heights = (counts / counts.max() * (height - 4)).round().to(torch.int64).numpy()
+
+    def px(v: float) -> int: return int((v - lo) / (hi - lo) * (width - 1))
+
+    # Bars as one vectorized mask.
+    ys = np.arange(height)[:, None]
+    xs_bin = np.minimum(np.arange(width) * bins // width, bins - 1)
+    mask = ys >= height - heights[xs_bin][None, :]
+    pixels = np.asarray(img).copy()
+    pixels[:height][mask] = (31, 119, 180)
+    img = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(img)
+
+    for k, color in ((-1, "orange"), (1, "orange"), (0, "red")):
+        v = mean + k * std
+        if lo <= v <= hi: draw.line([(px(v), 0), (px(v), height)], fill=color)
+    if lo <= 0 <= hi: draw.line([(px(0), height - 2), (px(0), height + 2)], fill="black")
+    draw.line([(0, height), (width, height)], fill="black")
+    draw.text((2, height + 4), f"{lo:.3g}", fill="black")
+    label = f"{hi:.3g}"
+    draw.text((width - 2 - draw.textlength(label), height + 4), label, fill="black")
+    label = f"mean={mean:.3f}  std={std:.3f}"
+    draw.text(((width - draw.textlength(label)) // 2, height + 4), label, fill="black")
+    return img
+
+
+def plot_png(x: torch.Tensor, renderer: str) -> bytes:
+    if renderer == "fast": return _png(histogram_image(x))
+    return _fig_png(lt.plot(x, center="range").fig, pad_inches=0.1)
+
+
+def chans_png(x: torch.Tensor, renderer: str) -> bytes:
+    if renderer == "fast": return _png(chans_image(x, scale=2))
+    return _fig_png(lt.chans(x, scale=2).fig, pad_inches=0)
+
+
+def subsample(x: torch.Tensor, max_elements: int, seed: int = 0) -> torch.Tensor:
+    """x flattened, or a seeded random sample of max_elements of its elements (0 for no limit)"""
+    flat = x.flatten()
+    if max_elements == 0 or flat.numel() <= max_elements: return flat
+    generator = torch.Generator(device=flat.device).manual_seed(seed)
+    return flat[torch.randint(flat.numel(), (max_elements,), generator=generator, device=flat.device)]
+
+
+def downsample_images(x: torch.Tensor, max_pixels: int) -> tuple[torch.Tensor, int]:
+    """Area-downsample the ...,H,W images so the total is at most max_pixels (0 for no limit). Returns (images, factor).
+
+    Images are not made smaller than 8 pixels. If that's not enough, the largest leading dimensions are strided instead.
+    """
+    if max_pixels == 0 or x.numel() <= max_pixels or x.dim() < 2: return x, 1
+    h, w = x.shape[-2:]
+    factor = min(math.ceil(math.sqrt(x.numel() / max_pixels)), max(1, min(h, w) // 8))
+    if factor > 1:
+        images = torch.nn.functional.interpolate(x.float().reshape(-1, 1, h, w), size=(math.ceil(h / factor), math.ceil(w / factor)), mode="area")
+        x = images.reshape(*x.shape[:-2], *images.shape[-2:])
+
+    # Still too large, keep every n-th batch item / frame / channel.
+    for dim in sorted(range(x.dim() - 2), key=lambda d: -x.shape[d]):
+        if x.numel() <= max_pixels: break
+        step = math.ceil(x.numel() / max_pixels)
+        x = x[(slice(None),) * dim + (slice(None, None, step),)]
+    return x, factor
@@ -1,6 +1,9 @@
+import re
 import torch
 import math
 
+from .noise import latent_samples, latent_shape
+
 class LTLatentToShape:
     max_dim: int = 7
     @classmethod
@@ -18,7 +21,8 @@ class LTLatentToShape:
     FUNCTION = "shape"
 
     def shape(self, input: torch.Tensor):
-        shape_list = list(input["samples"].shape)
+        # Lazy noise doesn't need to be generated for this.
+        shape_list = list(latent_shape(input))
 
         if len(shape_list) > self.max_dim: shape_list = shape_list[:self.max_dim]
 
@@ -27,6 +31,34 @@ class LTLatentToShape:
         return tuple(shape_list)
 
 
+def is_view_of(x: torch.Tensor, base: torch.Tensor) -> bool:
+    """x shares the memory of base"""
+    return x.untyped_storage().data_ptr() == base.untyped_storage().data_ptr()
+
+
+def reshape_repeat(samples: torch.Tensor, dimensions: list[int]) -> torch.Tensor:
+    """samples flattened, cropped or repeated to fill dimensions. A view whenever the strides allow it"""
+    input_size, output_size = samples.numel(), math.prod(dimensions)
+    if output_size == input_size:
+        return samples.reshape(dimensions)
+    if output_size < input_size:
+        return samples.reshape(-1)[:output_size].view(dimensions)
+
+    repeats, rest = divmod(output_size, input_size)
+    if rest == 0:
+        # If the trailing dims hold exactly one copy, the leading dims are repeats: a broadcast view.
+        for k in range(len(dimensions)):
+            if math.prod(dimensions[k:]) == input_size:
+                return samples.reshape(dimensions[k:]).expand(dimensions)
+
+    # One copy of exactly the output size.
+    flat = samples.reshape(-1)
+    out = flat.new_empty(output_size)
+    out[:repeats * input_size].view(repeats, input_size).copy_(flat)
+    out[repeats * input_size:].copy_(flat[:rest])
+    return out.view(dimensions)
+
+
 class LTReshapeLatent:
     @classmethod
     def INPUT_TYPES(cls):
@@ -46,11 +78,13 @@ class LTReshapeLatent:
 
     CATEGORY = "LatentTools"
     DESCRIPTION = "Reshape a latent tensor"
-    RETURN_TYPES = ("LATENT",)
+    RETURN_TYPES = ("LATENT", "BOOLEAN")
+    RETURN_NAMES = ("latent", "is_view")
+    OUTPUT_TOOLTIPS = ("The reshaped latent", "True if the output shares the memory of the input, nothing was copied")
     FUNCTION = "reshape"
 
     def reshape(self, input, strict, dim0, dim1, dim2, dim3, dim4, dim5, dim6):
-        samples: torch.Tensor = input["samples"]
+        samples: torch.Tensor = latent_samples(input)
 
         dimensions = [dim for dim in [dim0, dim1, dim2, dim3, dim4, dim5, dim6] if dim > 0]
 
@@ -60,13 +94,140 @@ class LTReshapeLatent:
         if strict and input_size != output_size:
             raise ValueError(f"Input size {input_size} doesn't match output size {output_size} in strict mode")
 
-        reshaped = samples.reshape(-1)
+        reshaped = reshape_repeat(samples, dimensions)
+
+        return ({"samples": reshaped}, is_view_of(reshaped, samples))
+
+
+tile_modes = ["tile", "interleave", "new_dim"]
+
+
+def tile(samples: torch.Tensor, dim: int, repeats: int, mode: str) -> torch.Tensor:
+    """Repeat samples along dim, with expand where possible"""
+    if not -samples.dim() <= dim < samples.dim(): raise ValueError(f"dim {dim} is out of range for {samples.dim()} dimensions")
+    dim = dim % samples.dim()
+    if mode == "new_dim":
+        x = samples.unsqueeze(dim)
+        return x.expand(*x.shape[:dim], repeats, *x.shape[dim + 1:])
+    if mode not in tile_modes: raise ValueError(f"Unknown mode: {mode}. Expected one of {tile_modes}")
+    if samples.shape[dim] == 1:
+        return samples.expand(*samples.shape[:dim], repeats, *samples.shape[dim + 1:])
+    # Merging the repeats with a dim of size > 1 can't be done with strides.
+    if mode == "interleave":
+        return samples.repeat_interleave(repeats, dim=dim)
+    return samples.repeat(*[repeats if d == dim else 1 for d in range(samples.dim())])
+
+
+_dims_re = re.compile(r"\(([^()]*)\)|(\w+)")
+
+
+def _parse_side(side: str) -> list[list[str]]:
+    # "b c (t h) w" -> [["b"], ["c"], ["t", "h"], ["w"]]
+    # Anything the names and groups don't cover, like an unbalanced or nested parenthesis, is an error.
+    if _dims_re.sub(" ", side).strip() or side.count("(") != side.count(")"):
+        raise ValueError(f"Invalid dims '{side.strip()}': expected names and (grouped names), e.g. 'b c (t h) w'")
+    return [m[1].split() if m[1] is not None else [m[2]] for m in _dims_re.finditer(side)]
+
+
+def parse_pattern(pattern: str) -> tuple[list[list[str]], list[list[str]]]:
+    """The groups of names on each side of a pattern like "b c t h w -> (b t) c h w". Raises ValueError if it's invalid"""
+    if pattern.count("->") != 1: raise ValueError(f"Expected 'input dims -> output dims', got '{pattern}'")
+    left, right = (_parse_side(side) for side in pattern.split("->"))
+    names = [name for group in left for name in group]
+    if sorted(names) != sorted(name for group in right for name in group) or len(set(names)) != len(names):
+        raise ValueError(f"The two sides of '{pattern}' must have the same names, each once")
+    return left, right
+
+
+def rearrange(samples: torch.Tensor, pattern: str, sizes: dict[str, int] | None = None) -> torch.Tensor:
+    """A small einops.rearrange: "b c t h w -> (b t) c h w". Only copies if the output can't be expressed with strides.
+
+    Groups on the left side need the sizes of all but one of their names.
+    """
+    left, right = parse_pattern(pattern)
+    if len(left) != samples.dim():
+        raise ValueError(f"'{pattern}' has {len(left)} input dims, the latent has {samples.dim()}: {list(samples.shape)}")
+
+    known = dict(sizes or {})
+    for group, size in zip(left, samples.shape):
+        unknown = [name for name in group if name not in known]
+        product = math.prod(known[name] for name in group if name in known)
+        if len(unknown) > 1: raise ValueError(f"Sizes needed for all but one of {group} in '{pattern}'")
+        if unknown:
+            known[unknown[0]] = size // product if product else 0
+        if math.prod(known[name] for name in group) != size:
+            raise ValueError(f"The sizes of {group} don't multiply to {size}")
+
+    names = [name for group in left for name in group]
+    order = [names.index(name) for group in right for name in group]
+    split = samples.reshape([known[name] for name in names])
+    # The permute is always a view. The final reshape only copies when merged dims are not contiguous with each other.
+    return split.permute(order).reshape([math.prod(known[name] for name in group) for group in right])
+
 
-        # If output is larger than input and not strict, repeat elements
-        if output_size > input_size and not strict:
-            repeats_needed = (output_size + input_size - 1) // input_size
-            reshaped = reshaped.repeat(repeats_needed)[:output_size]
+def parse_sizes(text: str) -> dict[str, int]:
+    """"t=21, b=1" -> {"t": 21, "b": 1}"""
+    sizes = {}
+    for item in text.replace(",", " ").split():
+        name, eq, value = item.partition("=")
+        if not eq or not value.isdigit(): raise ValueError(f"Invalid size '{item}', expected name=number")
+        sizes[name] = int(value)
+    return sizes
 
-        reshaped = reshaped[:output_size].reshape(dimensions)
 
-        return ({"samples": reshaped},)
\ No newline at end of file
+class LTRearrangeLatent:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "input": ("LATENT", {}),
+                "pattern": ("STRING", {"default": "b c t h w -> (b t) c h w", "tooltip": "Input dims -> output dims, like einops.rearrange. Use (a b) to merge dims, or on the left side to split them"}),
+                "sizes": ("STRING", {"default": "", "tooltip": "Sizes for the dims split on the left side, e.g. t=21. Only one name in each group can be left out"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Permute, split and merge the dimensions of a latent tensor"
+    RETURN_TYPES = ("LATENT", "BOOLEAN")
+    RETURN_NAMES = ("latent", "is_view")
+    OUTPUT_TOOLTIPS = ("The rearranged latent", "True if the output shares the memory of the input, nothing was copied")
+    FUNCTION = "rearrange"
+
+    def rearrange(self, input, pattern: str, sizes: str):
+        samples: torch.Tensor = latent_samples(input)
+        out = rearrange(samples, pattern, parse_sizes(sizes))
+        return ({"samples": out}, is_view_of(out, samples))
+
+    @classmethod
+    def VALIDATE_INPUTS(cls, pattern, sizes):
+        try:
+            parse_pattern(pattern)
+            parse_sizes(sizes)
+        except ValueError as e:
+            return str(e)
+        return True
+
+
+class LTTileLatent:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "input": ("LATENT", {}),
+                "dim": ("INT", {"default": 0, "min": -10, "max": 10, "tooltip": "The dimension to tile along (supports negative indexing)"}),
+                "repeats": ("INT", {"default": 2, "min": 1, "max": 4096}),
+                "mode": (tile_modes, {"default": tile_modes[0], "tooltip": "tile: a, b, a, b. interleave: a, a, b, b. Both are views if dim has size 1, otherwise they need a copy. new_dim: insert a new dim of size repeats before dim, always a view"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Repeat a latent tensor along a dimension"
+    RETURN_TYPES = ("LATENT", "BOOLEAN")
+    RETURN_NAMES = ("latent", "is_view")
+    OUTPUT_TOOLTIPS = ("The tiled latent", "True if the output shares the memory of the input, nothing was copied")
+    FUNCTION = "tile"
+
+    def tile(self, input, dim: int, repeats: int, mode: str):
+        samples: torch.Tensor = latent_samples(input)
+        out = tile(samples, dim, repeats, mode)
+        return ({"samples": out}, is_view_of(out, samples))
@@ -0,0 +1,67 @@
+import os
+import csv
+import json
+import torch
+
+stats_options = ["off", "latent", "csv", "json"]
+stat_tensors = ("x", "x0")
+
+
+class StepStats:
+    """Records statistics of the latent and the denoised x0 at every sampler step.
+
+    The statistics stay on the device of the latent until trace() is called, so recording never waits for the GPU.
+    Per step and tensor: mean, std, abs max, then the mean and std of each channel.
+    """
+    def __init__(self):
+        self.stats: torch.Tensor | None = None
+        self.channels = 0
+
+    def _row(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.detach().float()
+        std, mean = torch.std_mean(x)
+        dims = [d for d in range(x.dim()) if d != 1]
+        ch_std, ch_mean = torch.std_mean(x, dim=dims)
+        return torch.cat([torch.stack([mean, std, x.abs().amax()]), torch.stack([ch_mean, ch_std], dim=-1).flatten()])
+
+    def record(self, step: int, x: torch.Tensor, x0: torch.Tensor, total_steps: int):
+        if self.stats is None:
+            self.channels = x.shape[1]
+            # NaN marks steps that were never recorded.
+            self.stats = torch.full((total_steps, len(stat_tensors), 3 + 2 * self.channels), torch.nan, device=x.device)
+        if step >= self.stats.shape[0]: return
+        for i, t in enumerate((x, x0)):
+            if t is not None: self.stats[step, i].copy_(self._row(t))
+
+    def callback(self, callback=None):
+        """Wrap a sampler callback(step, x0, x, total_steps)"""
+        def record_callback(step, x0, x, total_steps):
+            self.record(step, x, x0, total_steps)
+            if callback is not None: callback(step, x0, x, total_steps)
+        return record_callback
+
+    def columns(self) -> list[str]:
+        return ["mean", "std", "absmax"] + [f"ch{c}_{s}" for c in range(self.channels) for s in ("mean", "std")]
+
+    def trace(self) -> dict:
+        """{"columns": [...], "x": steps x columns tensor, "x0": ...} on the CPU"""
+        stats = self.stats.cpu() if self.stats is not None else torch.empty(0, len(stat_tensors), 3)
+        return {"columns": self.columns()} | {name: stats[:, i] for i, name in enumerate(stat_tensors)}
+
+
+def write_trace(path: str, trace: dict):
+    """Write the trace as .csv (one row per step and tensor) or .json"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            # NaN (steps that were not recorded) is not valid JSON.
+            rows = {name: [[None if v != v else v for v in row] for row in trace[name].tolist()] for name in stat_tensors}
+            json.dump({"columns": trace["columns"]} | rows, f)
+        return
+
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["step", "tensor"] + trace["columns"])
+        for step in range(trace["x"].shape[0]):
+            for name in stat_tensors:
+                writer.writerow([step, name] + trace[name][step].tolist())
@@ -1,39 +1,41 @@
 # Derived from KSampler from ComfyUI nodes.py
 # License for this file only: GPL v3
 
+import os
+import math
 import torch
-import numpy as np
 
 import comfy
 import comfy.sample
+import comfy.model_management
 import comfy.utils
 import comfy.samplers
+from comfy.k_diffusion import sampling as k_diffusion_sampling
 
+import folder_paths
 import latent_preview
 
+from .noise import latent_samples, latent_shape, lt_prepare_noise, NoiseTimeline, prefetch_options
+from .sampler_stats import StepStats, stats_options, write_trace
 
-def lt_prepare_noise(latent_noise, noise_inds=None):
 
-    if noise_inds is None:
-        return latent_noise
-
-    unique_inds = np.unique(noise_inds)
-    noises = [latent_noise[i:i+1] for i in unique_inds]
-    return torch.cat([noises[np.where(unique_inds == i)[0][0]] for i in noise_inds], dim=0)
-
-def common_lt_ksampler(model, latent_noise, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False):
+def common_lt_ksampler(model, latent_noise, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=1.0, disable_noise=False, start_step=None, last_step=None, force_full_denoise=False, step_stats="off"):
     latent_image_samples: torch.Tensor = latent_image["samples"]
-    latent_noise_samples: torch.Tensor = latent_noise["samples"]
+    latent_noise_shape = latent_shape(latent_noise)
     # latent_image_samples = comfy.sample.fix_empty_latent_channels(model, latent_image_samples)
     assert model.get_model_object("latent_format").latent_channels == latent_image_samples.shape[1], "Wrong number of latent channels"
-    assert latent_noise_samples.dim() == latent_image_samples.dim(), "Unexpected number of dimensions"
-    assert latent_noise_samples.shape[-3:] == latent_image_samples.shape[-3:], "Shape mismatch"
+    assert len(latent_noise_shape) == latent_image_samples.dim(), "Unexpected number of dimensions"
+    assert latent_noise_shape[-3:] == latent_image_samples.shape[-3:], "Shape mismatch"
 
     if disable_noise:
         noise = torch.zeros_like(latent_image_samples)
     else:
         batch_inds = latent_image["batch_index"] if "batch_index" in latent_image else None
-        noise = lt_prepare_noise(latent_noise_samples, batch_inds)
+        if "noise" in latent_noise:
+            # Lazy noise, only generate the items that are used.
+            noise = latent_noise["noise"].materialize(batch_inds)
+        else:
+            noise = lt_prepare_noise(latent_noise["samples"], batch_inds)
 
 
     # If we have 1 sample of noise, and multiple input images, broadcast the noise to match the input.
@@ -45,12 +47,22 @@ def common_lt_ksampler(model, latent_noise, extra_seed, steps, cfg, sampler_name
         noise_mask = latent_image["noise_mask"]
 
     callback = latent_preview.prepare_callback(model, steps)
+    recorder = None
+    if step_stats != "off":
+        if step_stats not in stats_options: raise ValueError(f"Unknown step_stats: {step_stats}. Expected one of {stats_options}")
+        recorder = StepStats()
+        callback = recorder.callback(callback)
     disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
     samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image_samples,
                                   denoise=denoise, disable_noise=disable_noise, start_step=start_step, last_step=last_step,
                                   force_full_denoise=force_full_denoise, noise_mask=noise_mask, callback=callback, disable_pbar=disable_pbar, seed=extra_seed)
     out = latent_image.copy()
     out["samples"] = samples
+    if recorder is not None:
+        out["step_stats"] = recorder.trace()
+        if step_stats in ("csv", "json"):
+            full_output_folder, filename, counter, _, _ = folder_paths.get_save_image_path("sampler_stats/LT_step_stats", folder_paths.get_output_directory())
+            write_trace(os.path.join(full_output_folder, f"{filename}_{counter:05}_.{step_stats}"), out["step_stats"])
     return (out, )
 
 class LTKSampler:
@@ -69,6 +81,7 @@ class LTKSampler:
                 "latent_image": ("LATENT", {"tooltip": "The latent image to denoise."}),
                 "latent_noise": ("LATENT", {"tooltip": "The latent noise to use for denoising."}),
                 "denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The amount of denoising applied, lower values will maintain the structure of the initial image allowing for image to image sampling."}),
+                "step_stats": (stats_options, {"default": "off", "tooltip": "Record the mean, std, abs max and per-channel moments of the latent and x0 at every step. latent: in the output latent under \"step_stats\". csv/json: also written to output/sampler_stats"}),
             }
         }
 
@@ -79,12 +92,118 @@ class LTKSampler:
     CATEGORY = "LatentTools"
     DESCRIPTION = "KSampler that accepts an additional input for latent noise"
 
-    def sample(self, model, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, latent_noise, denoise=1.0):
-        return common_lt_ksampler(model, latent_noise, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise)
+    def sample(self, model, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, latent_noise, denoise=1.0, step_stats="off"):
+        return common_lt_ksampler(model, latent_noise, extra_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, step_stats=step_stats)
+
+
+
+def _noise_items(latent_noise: dict, inds: list[int]) -> torch.Tensor:
+    if "noise" in latent_noise: return latent_noise["noise"].materialize(inds)
+    return lt_prepare_noise(latent_noise["samples"], inds)
+
+
+def _items_per_batch(model, shape: tuple[int, ...], max_batch: int) -> int:
+    """How many items of the latent shape fit in the free memory of the model's device, capped at max_batch (0 for no cap)"""
+    # The model is loaded by the sampling anyway. Load it now, the free memory is then what's left for sampling.
+    comfy.model_management.load_models_gpu([model])
+    free = comfy.model_management.get_free_memory(model.load_device)
+    # comfy's own estimate of the activations for one item, with the cond and uncond passes, plus the noise,
+    # the latent and the output.
+    per_item = model.model.memory_required([2, *shape[1:]]) + 3 * math.prod(shape[1:]) * 4
+    items = max(1, int(free * 0.9 // per_item))
+    return min(items, max_batch) if max_batch > 0 else items
+
+
+class LTKSamplerSweep:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "model": ("MODEL", {"tooltip": "The model used for denoising the input latent."}),
+                "extra_seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff, "tooltip": "The seed for any other noise used by the sampler. Connect a list to sweep it."}),
+                "noise_index": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "tooltip": "The item of latent_noise to start from. Connect a list to sweep it."}),
+                "cfg": ("FLOAT", {"default": 8.0, "min": 0.0, "max": 100.0, "step":0.1, "round": 0.01, "tooltip": "Classifier-Free Guidance scale. Connect a list to sweep it."}),
+                "steps": ("INT", {"default": 20, "min": 1, "max": 10000, "tooltip": "The number of steps used in the denoising process."}),
+                "sampler_name": (comfy.samplers.KSampler.SAMPLERS, {"tooltip": "The algorithm used when sampling, this can affect the quality, speed, and style of the generated output."}),
+                "scheduler": (comfy.samplers.KSampler.SCHEDULERS, {"tooltip": "The scheduler controls how noise is gradually removed to form the image."}),
+                "positive": ("CONDITIONING", {"tooltip": "The conditioning describing the attributes you want to include in the image."}),
+                "negative": ("CONDITIONING", {"tooltip": "The conditioning describing the attributes you want to exclude from the image."}),
+                "latent_image": ("LATENT", {"tooltip": "The latent image to denoise. A single item, or one item per item of latent_noise."}),
+                "latent_noise": ("LATENT", {"tooltip": "The latent noise to use for denoising."}),
+                "denoise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 1.0, "step": 0.01, "tooltip": "The amount of denoising applied, lower values will maintain the structure of the initial image allowing for image to image sampling."}),
+                "max_batch": ("INT", {"default": 0, "min": 0, "max": 4096, "tooltip": "The most variants sampled at once. The batches are also sized to fit in the free GPU memory. 0 for no limit beyond that. Only variants with the same extra_seed and cfg are batched together."}),
+            }
+        }
+
+    INPUT_IS_LIST = True
+    RETURN_TYPES = ("LATENT",)
+    OUTPUT_TOOLTIPS = ("The denoised latents, one per variant. latent[\"sweep\"] has the extra_seed, noise_index and cfg of each item.",)
+    FUNCTION = "sample"
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "KSampler for sweeps: samples every (extra_seed, noise_index, cfg) variant in batches, in a single run"
 
+    def sample(self, model, extra_seed, noise_index, cfg, steps, sampler_name, scheduler, positive, negative, latent_image, latent_noise, denoise, max_batch):
+        # Only the swept inputs are lists, the rest take the first value.
+        model, steps, sampler_name, scheduler, positive, negative, latent_image, latent_noise, denoise, max_batch = (
+            v[0] for v in (model, steps, sampler_name, scheduler, positive, negative, latent_image, latent_noise, denoise, max_batch))
 
+        # Shorter lists repeat their last value, like ComfyUI does for list inputs.
+        n = max(len(extra_seed), len(noise_index), len(cfg))
+        variants = [(extra_seed[min(i, len(extra_seed) - 1)], noise_index[min(i, len(noise_index) - 1)], cfg[min(i, len(cfg) - 1)]) for i in range(n)]
 
-class QSamplerEulerAncestral:
+        latent_image_samples: torch.Tensor = latent_image["samples"]
+        latent_noise_shape = latent_shape(latent_noise)
+        assert model.get_model_object("latent_format").latent_channels == latent_image_samples.shape[1], "Wrong number of latent channels"
+        assert len(latent_noise_shape) == latent_image_samples.dim(), "Unexpected number of dimensions"
+        assert latent_noise_shape[-3:] == latent_image_samples.shape[-3:], "Shape mismatch"
+        if latent_image_samples.shape[0] not in (1, latent_noise_shape[0]):
+            raise ValueError(f"latent_image must have 1 item or as many as latent_noise ({latent_noise_shape[0]}), got {latent_image_samples.shape[0]}")
+
+        # comfy samples a batch with a single cfg and seed, so only variants that share them can be batched together.
+        groups: dict[tuple, list[int]] = {}
+        for i, (seed, _, c) in enumerate(variants):
+            groups.setdefault((seed, c), []).append(i)
+
+        step = _items_per_batch(model, latent_noise_shape, max_batch)
+        batches = []
+        for (seed, c), items in groups.items():
+            batches += [(seed, c, items[j:j + step]) for j in range(0, len(items), step)]
+
+        noise_mask = latent_image.get("noise_mask", None)
+        disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
+        pbar = comfy.utils.ProgressBar(len(batches))
+        results = [None] * n
+        for seed, c, items in batches:
+            inds = [variants[i][1] for i in items]
+            noise = _noise_items(latent_noise, inds)
+            image = latent_image_samples if latent_image_samples.shape[0] == 1 else lt_prepare_noise(latent_image_samples, inds)
+            image = image.expand(len(items), *image.shape[1:])
+            mask = noise_mask
+            if mask is not None and mask.shape[0] > 1 and mask.shape[0] == latent_image_samples.shape[0]:
+                mask = lt_prepare_noise(mask, inds)
+
+            callback = latent_preview.prepare_callback(model, steps)
+            samples = comfy.sample.sample(model, noise, steps, c, sampler_name, scheduler, positive, negative, image,
+                                          denoise=denoise, noise_mask=mask, callback=callback, disable_pbar=disable_pbar, seed=seed)
+            for i, x in zip(items, samples.split(1)):
+                results[i] = x
+            pbar.update(1)
+
+        out = {k: v for k, v in latent_image.items() if k not in ("samples", "batch_index")}
+        out["samples"] = torch.cat(results)
+        out["sweep"] = [{"extra_seed": seed, "noise_index": index, "cfg": c} for seed, index, c in variants]
+        return (out, )
+
+
+def sample_euler_ancestral_timeline(model, x, sigmas, *args, noise_timeline: torch.Tensor, prefetch: str = "device", **kwargs):
+    # ComfyUI caches the SAMPLER and reuses it, start every run at the first step of a fresh timeline.
+    # The noise is only copied to the device for the duration of the sampling.
+    noise_sampler = NoiseTimeline(noise_timeline, x.device, prefetch)
+    return k_diffusion_sampling.sample_euler_ancestral(model, x, sigmas, *args, noise_sampler=noise_sampler, **kwargs)
+
+
+class LTSamplerEulerAncestral:
     @classmethod
     def INPUT_TYPES(s):
         return {"required":
@@ -92,30 +211,20 @@ class QSamplerEulerAncestral:
                         "model": ("MODEL", {}),
                         "eta": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 100.0, "step":0.01, "round": False}),
                         "s_noise": ("FLOAT", {"default": 1.0, "min": 0.0, "max": 100.0, "step":0.01, "round": False}),
-                        "noise_timeline": ("LATENT", {})
+                        "noise_timeline": ("LATENT", {"tooltip": "B,T,C,H,W noise, one T slice per step. Wraps around if there are fewer slices than steps"}),
+                        "prefetch": (prefetch_options, {"default": prefetch_options[0], "tooltip": "device: copy the whole timeline to the GPU once. stream: copy one step at a time on a side stream, ahead of when it's needed. Uses less GPU memory"}),
                         }
                }
     RETURN_TYPES = ("SAMPLER",)
-    CATEGORY = "sampling/custom_sampling/samplers"
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Euler ancestral sampler that takes the noise added at each step from a latent"
 
     FUNCTION = "get_sampler"
 
-    def get_sampler(self, model, eta, s_noise, noise_timeline: torch.Tensor):
-        noise_samples = noise_timeline["samples"]
-        if noise_samples.dim() == 4:
-            noise_samples = noise_samples.unsqueeze(1)
-
-        i = [0]
-        def noise_sampler(sigma, sigma_next):
-            print(f"noise_sampler {sigma} -> {sigma_next}")
-            print(noise_samples)
-
-            # return torch.randn((noise_samples.shape[0], *noise_samples.shape[2:]), device=model.load_device)
-            sample = noise_samples[:,i[0] % noise_samples.shape[1],:,:,:].to(model.load_device)
-            i[0] += 1
-            return sample
-
-        sampler = comfy.samplers.ksampler("euler_ancestral", {"eta": eta, "s_noise": s_noise, "noise_sampler":noise_sampler })
+    def get_sampler(self, model, eta, s_noise, noise_timeline: dict, prefetch="device"):
+        if prefetch not in prefetch_options: raise ValueError(f"Unknown prefetch: {prefetch}. Expected one of {prefetch_options}")
+        extra_options = {"eta": eta, "s_noise": s_noise, "noise_timeline": latent_samples(noise_timeline), "prefetch": prefetch}
+        sampler = comfy.samplers.KSAMPLER(sample_euler_ancestral_timeline, extra_options)
         return (sampler, )
 
 
@@ -144,7 +253,7 @@ class QSamplerCustom:
 
     def sample(self, model, extra_seed, cfg, positive, negative, sampler, sigmas, latent_image, latent_noise):
         latent_image_samples: torch.Tensor = latent_image["samples"]
-        latent_noise_samples: torch.Tensor = latent_noise["samples"]
+        latent_noise_samples: torch.Tensor = latent_samples(latent_noise)
         # latent_image_samples = comfy.sample.fix_empty_latent_channels(model, latent_image_samples)
         assert model.get_model_object("latent_format").latent_channels == latent_image_samples.shape[1], "Wrong number of latent channels"
         assert latent_noise_samples.dim() == latent_image_samples.dim(), "Unexpected number of dimensions"
@@ -0,0 +1,113 @@
+import os
+import time
+import torch
+import logging
+import threading
+import folder_paths
+from concurrent.futures import ThreadPoolExecutor
+
+from .latent_io import write_latent, write_index, _zstd
+from .noise import latent_samples
+
+save_formats = ["safetensors", "pt", "npy", "npz"]
+save_dtypes = {"keep": None, "fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+compressions = ["none", "zstd"]
+
+# One I/O thread, the writes are in queue order and the disk is not thrashed by parallel writes.
+_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="LTLatentSave")
+_io_lock = threading.Lock()
+# Name prefixes of the files that are queued but not written yet, so the next save does not pick the same counter.
+_pending: set[str] = set()
+
+
+def _write(files: list[tuple[str, torch.Tensor]], index: tuple[str, list, list[int], torch.dtype] | None, prefix: str, queued: float):
+    try:
+        start = time.perf_counter()
+        nbytes = 0
+        for path, samples in files:
+            # Never let a reader see a partially written file.
+            tmp = os.path.join(os.path.dirname(path), f".tmp_{os.path.basename(path)}")
+            try:
+                write_latent(tmp, samples)
+                nbytes += os.path.getsize(tmp)
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp): os.remove(tmp)
+                raise
+        if index is not None: write_index(*index)
+        end = time.perf_counter()
+
+        mib = nbytes / (1024 * 1024)
+        logging.info(f"LTLatentSave: {os.path.basename(files[0][0])}{f' and {len(files) - 1} more' if len(files) > 1 else ''}: "
+                     f"{mib:.1f} MiB in {(end - start) * 1000:.0f} ms ({mib / max(end - start, 1e-9):.0f} MiB/s), "
+                     f"{(end - queued) * 1000:.0f} ms after it was queued")
+    except Exception:
+        logging.exception("LTLatentSave: Writing failed")
+        raise
+    finally:
+        with _io_lock: _pending.discard(prefix)
+
+
+class LTLatentSave:
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "latent": ("LATENT", {}),
+                "filename_prefix": ("STRING", {"default": "latents/LT_latent", "tooltip": "The prefix for the file to save, relative to the output directory"}),
+                "format": (save_formats, {"default": save_formats[0], "tooltip": "All formats can be loaded back with LTLatentLoad"}),
+                "dtype": (list(save_dtypes), {"default": "keep", "tooltip": "Convert before saving. fp16/bf16 halve the size of fp32 latents. npy and npz store bf16 as fp32"}),
+                "compression": (compressions, {"default": "none", "tooltip": "zstd: compress the file (.zst is added to the name). Needs the zstandard package"}),
+                "shard_size": ("INT", {"default": 0, "min": 0, "max": 0xffff, "tooltip": "Split the batch into files of this many items, plus an .index.json that loads as the whole batch. 0 for a single file"}),
+                "background": ("BOOLEAN", {"default": True, "tooltip": "Write in a background thread, the queue does not wait for the disk"}),
+            }
+        }
+
+    CATEGORY = "LatentTools"
+    DESCRIPTION = "Save a latent to a .safetensors, .pt, .npy or .npz file"
+    FUNCTION = "save"
+    OUTPUT_NODE = True
+    RETURN_TYPES = ()
+
+    def save(self, latent: dict, filename_prefix: str, format: str, dtype: str = "keep", compression: str = "none", shard_size: int = 0, background: bool = True):
+        assert isinstance(latent, dict), f"Incorrect type for latent: Expected dict, got {type(latent)}"
+        samples = latent_samples(latent)
+        assert isinstance(samples, torch.Tensor), f"Incorrect type for latent.samples: Expected torch.Tensor, got {type(samples)}"
+        if format not in save_formats: raise ValueError(f"Unknown format: {format}. Expected one of {save_formats}")
+        if dtype not in save_dtypes: raise ValueError(f"Unknown dtype: {dtype}. Expected one of {list(save_dtypes)}")
+        if compression not in compressions: raise ValueError(f"Unknown compression: {compression}. Expected one of {compressions}")
+        # Fail now, not on the I/O thread after the files have been reported.
+        if compression == "zstd": _zstd()
+        queued = time.perf_counter()
+
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_output_directory())
+        with _io_lock:
+            # The files of the queued saves are not on disk yet.
+            while os.path.join(full_output_folder, f"{filename}_{counter:05}_") in _pending: counter += 1
+            prefix = os.path.join(full_output_folder, f"{filename}_{counter:05}_")
+            _pending.add(prefix)
+
+        # Convert on the device and copy to the CPU now, the I/O thread only writes.
+        samples = samples.detach()
+        if save_dtypes[dtype] is not None: samples = samples.to(save_dtypes[dtype])
+        samples = samples.cpu()
+
+        ext = f".{format}" + (".zst" if compression == "zstd" else "")
+        if shard_size > 0 and samples.dim() > 3 and samples.shape[0] > shard_size:
+            n = (samples.shape[0] + shard_size - 1) // shard_size
+            files = [(f"{prefix}{i:03}-of-{n:03}{ext}", samples[i * shard_size:(i + 1) * shard_size]) for i in range(n)]
+            index_path = f"{prefix}.index.json"
+            stored_dtype = torch.float32 if format in ("npy", "npz") and samples.dtype == torch.bfloat16 else samples.dtype
+            index = (index_path, [(path, i * shard_size, x.shape[0]) for i, (path, x) in enumerate(files)], list(samples.shape), stored_dtype)
+            names = [os.path.basename(index_path)] + [os.path.basename(path) for path, _ in files]
+        else:
+            files = [(f"{prefix}{ext}", samples)]
+            index = None
+            names = [os.path.basename(files[0][0])]
+
+        if background:
+            _io_pool.submit(_write, files, index, prefix, queued)
+        else:
+            _write(files, index, prefix, queued)
+
+        return {"ui": {"latents": [{"filename": name, "subfolder": subfolder, "type": "output"} for name in names]}}
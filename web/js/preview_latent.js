@@ -1,4 +1,5 @@
 import { app } from "../../scripts/app.js";
+import { api } from "../../scripts/api.js";
 
 function createContainer() {
   const container = document.createElement('div')
@@ -6,8 +7,62 @@ function createContainer() {
   return container
 }
 
+function imageUrl(image) {
+  const params = new URLSearchParams({ filename: image.filename, subfolder: image.subfolder, type: image.type })
+  return api.apiURL(`/view?${params}`)
+}
+
+// The images are named by the content of the latent, only replace the ones that have changed.
+// While the images are rendered in the background, they may not exist yet: keep showing the previous image, dimmed,
+// until the new one loads. The message that is sent when rendering is done loads them again.
+function updateImages(container, images) {
+  const existing = new Map([...container.children].map((el) => [el.dataset.title, el]))
+
+  images.forEach((image, i) => {
+    let el = existing.get(image.title)
+    existing.delete(image.title)
+    if (!el) {
+      el = document.createElement('div')
+      el.classList.add('flex', 'flex-col', 'gap-1')
+      el.dataset.title = image.title
+      el.append(`${image.title}:`, document.createElement('img'))
+    }
+    const img = el.querySelector('img')
+    if (img.dataset.filename !== image.filename) {
+      el.style.opacity = 0.5
+      img.dataset.wanted = image.filename
+      const loader = new Image()
+      loader.onload = () => {
+        // A newer image was requested in the meantime.
+        if (img.dataset.wanted !== image.filename) return
+        img.dataset.filename = image.filename
+        img.src = loader.src
+        el.style.opacity = 1
+      }
+      loader.src = imageUrl(image)
+    }
+    if (container.children[i] !== el) container.insertBefore(el, container.children[i] ?? null)
+  })
+
+  existing.forEach((el) => el.remove())
+}
+
+function showPreview(node, message) {
+  const previewWidget = node.widgets?.find((w) => w.name === 'summary')
+  if (!previewWidget) return
+  const [text, images] = previewWidget.element.children
+  text.innerHTML = message.html[0]
+  updateImages(images, message.lt_images ?? [])
+}
+
 app.registerExtension({
   name: 'LatentTools.LTPreviewLatent',
+  setup() {
+    api.addEventListener('latent_tools.preview', ({ detail }) => {
+      const node = app.graph.getNodeById(detail.node)
+      if (node) showPreview(node, detail)
+    })
+  },
   async beforeRegisterNodeDef(nodeType, nodeData) {
     if (nodeData.name === 'LTPreviewLatent') {
       const onNodeCreated = nodeType.prototype.onNodeCreated
@@ -17,6 +72,11 @@ app.registerExtension({
         let summary = document.createElement('div')
         summary.style.overflow="auto";
 
+        let text = document.createElement('div')
+        let images = document.createElement('div')
+        images.classList.add('flex', 'flex-col', 'gap-0.5')
+        summary.append(text, images)
+
         this.addDOMWidget("summary", 'image', summary, {   })
       }
 
@@ -27,10 +87,7 @@ app.registerExtension({
           ? void 0
           : onExecuted.apply(this, [message])
 
-        const previewWidget = this.widgets?.find((w) => w.name === 'summary')
-        if (previewWidget) {
-          previewWidget.element.innerHTML = message.html[0]
-        }
+        showPreview(this, message)
       }
     }
   }